@@ -26,8 +26,11 @@ target_metadata = model.Base.metadata
 # my_important_option = config.get_main_option("my_important_option")
 # ... etc.
 
-from src import app
-config.set_main_option('sqlalchemy.url', model.StaticDatabaseProxy(settings=app.settings)._url)
+# src.migrate hands us an open connection per tenant database,
+# otherwise migrate the app's own database
+if "connection" not in config.attributes:
+    from src.settings import Settings
+    config.set_main_option('sqlalchemy.url', model.StaticDatabaseProxy(settings=Settings())._url)
 
 
 def run_migrations_offline() -> None:
@@ -62,6 +65,18 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            render_as_batch=True,
+        )
+
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section),
         prefix="sqlalchemy.",
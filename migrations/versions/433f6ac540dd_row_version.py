@@ -0,0 +1,32 @@
+"""row version columns for optimistic locking
+
+Revision ID: 433f6ac540dd
+Revises: 20ae18b6f647
+Create Date: 2026-10-19 09:12:41.508112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '433f6ac540dd'
+down_revision = '20ae18b6f647'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('invoice', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+    with op.batch_alter_table('project', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('project', schema=None) as batch_op:
+        batch_op.drop_column('version')
+
+    with op.batch_alter_table('invoice', schema=None) as batch_op:
+        batch_op.drop_column('version')
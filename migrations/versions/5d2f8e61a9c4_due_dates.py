@@ -0,0 +1,38 @@
+"""invoiced_at on deliverables and a partial index for the due list
+
+Revision ID: 5d2f8e61a9c4
+Revises: 7c1e9a4b2d53
+Create Date: 2026-10-19 15:06:27.318840
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2f8e61a9c4'
+down_revision = '7c1e9a4b2d53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('deliverable', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('invoiced_at', sa.DATETIME(), nullable=True))
+
+    op.execute(
+        "UPDATE deliverable SET invoiced_at = CURRENT_TIMESTAMP "
+        "WHERE id IN (SELECT deliverable_id FROM invoice_line_item)"
+    )
+
+    with op.batch_alter_table('deliverable', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_deliverable_due', ['due_date', 'id'], unique=False,
+            sqlite_where=sa.text('archived_at IS NULL AND invoiced_at IS NULL AND due_date IS NOT NULL'),
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('deliverable', schema=None) as batch_op:
+        batch_op.drop_index('ix_deliverable_due')
+        batch_op.drop_column('invoiced_at')
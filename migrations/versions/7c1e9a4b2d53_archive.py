@@ -0,0 +1,47 @@
+"""archived_at soft-delete columns, partial indexes on live rows, project names unique among live projects
+
+Revision ID: 7c1e9a4b2d53
+Revises: 433f6ac540dd
+Create Date: 2026-10-19 11:40:02.174935
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e9a4b2d53'
+down_revision = '433f6ac540dd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('project', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('archived_at', sa.DATETIME(), nullable=True))
+        # archived projects keep their name, and names were unique across all projects until now
+        batch_op.drop_index('ix_project_name')
+        batch_op.create_index('ix_project_name_live', ['name'], unique=True, sqlite_where=sa.text('archived_at IS NULL'))
+
+    with op.batch_alter_table('deliverable', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('archived_at', sa.DATETIME(), nullable=True))
+        batch_op.create_index('ix_deliverable_live', ['project_id', 'created'], unique=False, sqlite_where=sa.text('archived_at IS NULL'))
+
+    with op.batch_alter_table('invoice', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('archived_at', sa.DATETIME(), nullable=True))
+        batch_op.create_index('ix_invoice_live', ['project_id'], unique=False, sqlite_where=sa.text('archived_at IS NULL'))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('invoice', schema=None) as batch_op:
+        batch_op.drop_index('ix_invoice_live')
+        batch_op.drop_column('archived_at')
+
+    with op.batch_alter_table('deliverable', schema=None) as batch_op:
+        batch_op.drop_index('ix_deliverable_live')
+        batch_op.drop_column('archived_at')
+
+    with op.batch_alter_table('project', schema=None) as batch_op:
+        batch_op.drop_index('ix_project_name_live')
+        batch_op.create_index('ix_project_name', ['name'], unique=True)
+        batch_op.drop_column('archived_at')
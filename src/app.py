@@ -1,101 +1,346 @@
+import asyncio
 import json
 import logging
+import math
 import os
+import random
 from contextlib import contextmanager
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from decimal import Decimal
+from functools import cached_property
 from http import HTTPStatus
 from io import UnsupportedOperation
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
 import sqlalchemy
-from fastapi import Depends, FastAPI, Form, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import APIRouter, Depends, FastAPI, Form, Header, HTTPException, Request
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi_jinja_utils import Jinja2TemplatesDependency, Renderable
 from fastapi_utils.cbv import cbv
-from sqlalchemy.orm import joinedload
-
-from . import model
-from .auth import MultitenantAuth, NoopAuth, PrivateInstanceAuth
-from .exceptions import RefreshDatabaseError, Unauthorized
+from sqlalchemy import lambda_stmt, select
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm.exc import StaleDataError
+
+from . import backup, model, read_models
+from .assets import StaticAssets, StaticAssetsMiddleware
+from .auth import AuthInterface, MultitenantAuth, NoopAuth, PrivateInstanceAuth
+from .cache import BillToHeader, ProjectHeader, TTLCache
+from .exceptions import DatabaseBusyError, DatabaseConflictError, QuotaExceededError, RefreshDatabaseError, Unauthorized
+from .idempotency import Idempotency, fingerprint, new_key
+from .maintenance import MaintenanceScheduler
+from .memory_tenants import InMemoryMultitenantDatabaseProxy
+from .quota import TenantQuotas
 from .settings import Settings
-from .utils import render_currency
+from .utils import render_cents, render_currency
 
 logger = logging.getLogger(__name__)
 
-settings = Settings()
-
 ROOT_DIR = Path(__file__).parent
 
-server = FastAPI()
-
-server.mount("/static", StaticFiles(directory=ROOT_DIR / "static"), name="static")
-
-# invoice config data
-try:
-    with open(ROOT_DIR.parent / ".deliverables.json", "r") as f:
-        config_constants = json.load(f)
-except FileNotFoundError:
-    config_constants = {
-        "my_name": os.getenv("CONFIG_MY_NAME", "<Name>"),
-        "my_address_1": os.getenv("CONFIG_ADDRESS_1", "<Address 1>"),
-        "my_address_2": os.getenv("CONFIG_MY_ADDRESS_2", "<Address 2>"),
-    }
-
-templates_dir = ROOT_DIR / "templates"
-jinja_globals = {
-    "currency": render_currency,
-    **config_constants
-}
-Templates = Jinja2TemplatesDependency(template_dir=templates_dir, env_globals=jinja_globals)
-
-match settings.DEPLOYMENT:
-    case "local":
-        auth = NoopAuth(server)
-        db_proxy = model.StaticDatabaseProxy(settings=settings)    
-    case "private":
-        auth = PrivateInstanceAuth(settings.PASSWORD, settings.SECRET_KEY, "/login", server)
-        db_proxy = model.StaticDatabaseProxy(settings=settings)
-    case "demo":
-        auth = MultitenantAuth(server)
-        db_proxy = model.MultitenantDatabaseProxy(database_directory=settings.DATABASE_DIRECTORY)
-    case other:
-        raise RuntimeError(f"DEPLOYMENT variable invalid value: {other}")
-
+router = APIRouter()
+
+
+class Services:
+    """What the views need, each piece built on first use instead of at import time"""
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.auth: Optional[AuthInterface] = None
+
+    @cached_property
+    def db_proxy(self) -> model.DatabaseProxy:
+        settings = self.settings
+        if settings.DEPLOYMENT == "demo" and settings.DEMO_STORAGE == "memory":
+            return InMemoryMultitenantDatabaseProxy(
+                database_directory=settings.DATABASE_DIRECTORY,
+                busy_timeout=settings.DATABASE_BUSY_TIMEOUT,
+                quotas=self.quotas,
+                persist_interval=settings.MEMORY_PERSIST_INTERVAL,
+                idle_seconds=settings.MEMORY_IDLE_TENANT_SECONDS,
+                max_tenants=settings.MEMORY_MAX_TENANTS,
+            )
+        if settings.DEPLOYMENT == "demo":
+            return model.MultitenantDatabaseProxy(
+                database_directory=settings.DATABASE_DIRECTORY,
+                busy_timeout=settings.DATABASE_BUSY_TIMEOUT,
+                quotas=self.quotas,
+            )
+        return model.StaticDatabaseProxy(settings=settings)
+
+    @cached_property
+    def quotas(self) -> Optional[TenantQuotas]:
+        # only demo tenants are strangers sharing one server
+        if self.settings.DEPLOYMENT != "demo":
+            return None
+        return TenantQuotas(
+            request_rate=self.settings.QUOTA_REQUEST_RATE,
+            request_burst=self.settings.QUOTA_REQUEST_BURST,
+            sql_budget=self.settings.QUOTA_SQL_BUDGET,
+            sql_window=self.settings.QUOTA_SQL_WINDOW,
+            query_time_limit=self.settings.QUOTA_QUERY_TIME_LIMIT,
+        )
+
+    @cached_property
+    def header_cache(self) -> TTLCache:
+        # project name and bill-to are on nearly every page but almost never change
+        return TTLCache(max_size=self.settings.HEADER_CACHE_SIZE, ttl=self.settings.HEADER_CACHE_TTL)
+
+    @cached_property
+    def maintenance(self) -> MaintenanceScheduler:
+        settings = self.settings
+        return MaintenanceScheduler(
+            self.db_proxy,
+            interval=settings.MAINTENANCE_INTERVAL,
+            page_budget=settings.MAINTENANCE_PAGE_BUDGET,
+            pause=settings.MAINTENANCE_PAUSE,
+            idle_tenant_seconds=settings.MAINTENANCE_IDLE_TENANT_DAYS * 24 * 60 * 60,
+            idempotency_key_ttl=settings.IDEMPOTENCY_KEY_TTL,
+        )
+
+    @cached_property
+    def static_assets(self) -> StaticAssets:
+        return StaticAssets(ROOT_DIR / "static")
+
+    @cached_property
+    def templates(self) -> Jinja2TemplatesDependency:
+        # invoice config data
+        try:
+            with open(ROOT_DIR.parent / ".deliverables.json", "r") as f:
+                config_constants = json.load(f)
+        except FileNotFoundError:
+            config_constants = {
+                "my_name": os.getenv("CONFIG_MY_NAME", "<Name>"),
+                "my_address_1": os.getenv("CONFIG_ADDRESS_1", "<Address 1>"),
+                "my_address_2": os.getenv("CONFIG_MY_ADDRESS_2", "<Address 2>"),
+            }
+        jinja_globals = {
+            "currency": render_currency,
+            "cents": render_cents,
+            "static_url": self.static_assets.url,
+            "idempotency_key": new_key,
+            **config_constants
+        }
+        return Jinja2TemplatesDependency(template_dir=ROOT_DIR / "templates", env_globals=jinja_globals)
+
+
+services: Services
+
+
+def create_auth(settings: Settings, server: FastAPI) -> AuthInterface:
+    match settings.DEPLOYMENT:
+        case "local":
+            return NoopAuth(server)
+        case "private":
+            return PrivateInstanceAuth(settings.PASSWORD, settings.SECRET_KEY, "/login", server)
+        case "demo":
+            return MultitenantAuth(settings.SECRET_KEY, server)
+        case other:
+            raise RuntimeError(f"DEPLOYMENT variable invalid value: {other}")
+
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """`uvicorn --factory src.app:create_app`"""
+    global services
+    services = Services(settings or Settings())
+    server = FastAPI()
+    services.auth = create_auth(services.settings, server)
+    server.include_router(router)
+    # the last added runs first: static files, auth, quotas, then retries,
+    # so a replayed request is only authenticated and charged once
+    server.middleware("http")(retry_refreshed_database_middleware)
+    server.middleware("http")(quota_middleware)
+    server.middleware("http")(authentication_middleware)
+    server.add_middleware(StaticAssetsMiddleware, assets=services.static_assets)
+    server.on_event("startup")(start_maintenance)
+    server.on_event("shutdown")(stop_maintenance)
+    server.on_event("shutdown")(log_cache_stats)
+    return server
+
+
+def __getattr__(name):
+    # keeps `uvicorn src.app:server` working without building an app on every import
+    if name == "server":
+        global server
+        server = create_app()
+        return server
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def start_maintenance():
+    if services.settings.MAINTENANCE_INTERVAL > 0:
+        services.maintenance.start()
+    if isinstance(services.db_proxy, InMemoryMultitenantDatabaseProxy):
+        services.db_proxy.start()
+
+
+def stop_maintenance():
+    if "maintenance" in vars(services):
+        services.maintenance.stop()
+    # after maintenance, which may still be deleting tenants
+    if isinstance(vars(services).get("db_proxy"), InMemoryMultitenantDatabaseProxy):
+        services.db_proxy.stop()
+
+
+def log_cache_stats():
+    # what to size HEADER_CACHE_SIZE and HEADER_CACHE_TTL by
+    if "header_cache" in vars(services):
+        logger.info("Project header cache: %s", services.header_cache.stats())
 
 
 def get_tenant_id(request: Request):
-    return auth.get_tenant_id(request=request)
+    return services.auth.get_tenant_id(request=request)
+
+
+async def get_idempotency(
+    request: Request,
+    idempotency_key: Optional[str] = Form(None),
+    idempotency_key_header: Optional[str] = Header(None, alias="Idempotency-Key"),
+) -> Idempotency:
+    key = idempotency_key_header or idempotency_key or None
+    # already parsed for the route's own fields, this is the cached copy
+    form = await request.form() if key is not None else None
+    try:
+        return Idempotency(
+            key, request.url.path, ttl=services.settings.IDEMPOTENCY_KEY_TTL,
+            fingerprint=fingerprint(form.multi_items()) if form is not None else None,
+        )
+    except ValueError as e:
+        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, detail=str(e))
+
+
+def get_templates(request: Request) -> Renderable:
+    return services.templates(request)
+
+
+# bytes of rendered HTML gathered before a chunk is sent
+STREAM_BUFFER_SIZE = 64 * 1024
+
+
+def _buffered(fragments: Iterator[str], size: int) -> Iterator[bytes]:
+    # generate() yields every text fragment separately, each one would be its own send
+    buffer, length = [], 0
+    for fragment in fragments:
+        buffer.append(fragment)
+        length += len(fragment)
+        if length >= size:
+            yield "".join(buffer).encode("utf-8")
+            buffer, length = [], 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def render_stream(request: Request, name: str, context: dict) -> StreamingResponse:
+    """Like `render`, but the page is sent as Jinja's generate() produces it.
+
+    Load everything into `context` first, with the session already closed: once
+    the template runs the status line is sent, and a database error, quota or retry
+    could only cut the page short.
+    """
+    template = services.templates.templates.get_template(name)
+    fragments = template.generate({"request": request, **context})
+    return StreamingResponse(_buffered(fragments, STREAM_BUFFER_SIZE), media_type="text/html")
 
 
-@server.middleware("http")
 async def authentication_middleware(request: Request, call_next):
     try: 
-        auth.is_authenticated(request=request)
-        return await call_next(request)
+        services.auth.is_authenticated(request=request)
+        response = await call_next(request)
+        services.auth.finish_response(request=request, response=response)
+        return response
     except Unauthorized as e:
         return e.response
 
-@server.middleware("http")
-async def retry_refreshed_database_middleware(request: Request, call_next):
-    try: 
+
+async def quota_middleware(request: Request, call_next):
+    quotas = services.quotas
+    tenant_id = services.auth.get_tenant_id(request=request)
+    # a visitor's first read has no bucket to spend yet, and would only push out those that do
+    new_session = getattr(request.state, "new_session", False)
+    try:
+        if quotas is not None and tenant_id is not None and not new_session:
+            quotas.check(tenant_id)
         return await call_next(request)
-    except RefreshDatabaseError:
-        return RedirectResponse(request.url, status_code=303)
-    except model.DatabaseLimitExceededError:
-        return RedirectResponse("/db-limit-exceeded", status_code=303)
+    except QuotaExceededError as e:
+        logger.warning("Tenant %s over quota on %s", tenant_id, request.url.path)
+        return PlainTextResponse(
+            "Too many requests, please slow down", status_code=429,
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+        )
+
+
+# GET and HEAD have no body, a POST's form is small enough to hold on to
+REPLAYED_METHODS = ("GET", "HEAD", "POST")
+
+
+def _replayable_request(request: Request, body: bytes) -> Request:
+    """A copy of `request` whose body can be read again by a retried handler"""
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await request.receive()
+
+    return Request(request.scope, receive=receive)
+
+
+async def retry_refreshed_database_middleware(request: Request, call_next):
+    # a failed attempt rolls back its transaction, so the whole request can be replayed
+    replayed = request.method in REPLAYED_METHODS
+    body = await request.body() if request.method == "POST" else b""
+    attempt = 0
+    while True:
+        try: 
+            return await call_next(_replayable_request(request, body) if replayed else request)
+        except RefreshDatabaseError:
+            return RedirectResponse(request.url, status_code=303)
+        except model.DatabaseLimitExceededError:
+            return RedirectResponse("/db-limit-exceeded", status_code=303)
+        except DatabaseConflictError:
+            # the row changed since the form was rendered, replaying the form would overwrite that
+            return PlainTextResponse("Conflicting update, please reload and try again", status_code=409)
+        except DatabaseBusyError as e:
+            if not replayed or attempt >= services.settings.DATABASE_RETRY_ATTEMPTS:
+                logger.warning("Giving up on %s after %d retries: %r", request.url.path, attempt, e)
+                return PlainTextResponse("Database busy", status_code=503, headers={"Retry-After": "1"})
+            delay = services.settings.DATABASE_RETRY_BACKOFF * (2 ** attempt)
+            await asyncio.sleep(delay + random.uniform(0, delay))
+            attempt += 1
+
+
+def check_version(entity, version: Optional[int]):
+    """A form rendered from an older `version` of the entity would overwrite whatever changed since"""
+    if version is not None and version != entity.version:
+        raise DatabaseConflictError()
 
 
 @contextmanager
-def get_db(tenant_id: Optional[str]):
-    db = db_proxy.get_session(tenant_id=tenant_id)
+def get_db(tenant_id: Optional[str], readonly: bool = False):
+    db = services.db_proxy.get_session(tenant_id=tenant_id, readonly=readonly)
     try:
         yield db
-    except sqlalchemy.exc.OperationalError as e:
-        logger.exception("Database OperationalError")
-        db_proxy.recreate_database(tenant_id=tenant_id)
+    except StaleDataError as e:
+        logger.warning("Concurrent update detected: %s", e)
+        raise DatabaseConflictError() from e
+    except sqlalchemy.exc.DatabaseError as e:
+        db.close()
+        if model.is_database_busy(e):
+            logger.warning("Database busy: %s", e.orig)
+            raise DatabaseBusyError() from e
+        if model.is_query_interrupted(e):
+            logger.warning("Query interrupted for running too long: %s", e.statement)
+            raise QuotaExceededError() from e
+        if isinstance(e, sqlalchemy.exc.IntegrityError):
+            raise
+        logger.exception("Database error")
+        if services.db_proxy.check_integrity(tenant_id=tenant_id):
+            raise
+        logger.error("Database failed integrity check, recreating")
+        services.db_proxy.recreate_database(tenant_id=tenant_id)
+        services.header_cache.invalidate_tenant(tenant_id)
         raise RefreshDatabaseError()
     except model.DatabaseLimitExceededError as e:
         logger.exception("Database at max size!")
@@ -104,58 +349,134 @@ def get_db(tenant_id: Optional[str]):
         db.close()
 
 
+# lambda statements are built and compiled once, later calls only bind the closure variables
 def get_project(id, db):
-    return db.query(model.Project).filter_by(id=id).options(joinedload(model.Project.deliverables), joinedload(model.Project.invoices)).first()
+    return db.execute(lambda_stmt(lambda: select(model.Project).where(
+        model.Project.id == id, model.Project.archived_at.is_(None),
+    ).options(selectinload(model.Project.deliverables), selectinload(model.Project.invoices)))).scalars().first()
 
 
-def get_invoice(invoice_id, db):
-    return db.query(model.Invoice).get(invoice_id)
+def get_invoice(project_id, invoice_id, db) -> model.Invoice:
+    """The project's live invoice, or a 404"""
+    try:
+        # an int id finds the invoice get_project already loaded in the identity map, a str misses it
+        invoice = db.get(model.Invoice, int(invoice_id))
+        project_id = int(project_id)
+    except ValueError:
+        invoice = None
+    if invoice is None or invoice.archived or invoice.project_id != project_id:
+        raise HTTPException(HTTPStatus.NOT_FOUND, detail="No such invoice on this project")
+    return invoice
+
+
+def get_project_header(tenant_id: Optional[str], project_id, db) -> Optional[ProjectHeader]:
+    def load():
+        row = db.execute(lambda_stmt(lambda: select(
+            model.Project.id, model.Project.name,
+            model.BillTo.id, model.BillTo.company_name, model.BillTo.contact_name, model.BillTo.contact_email,
+        ).outerjoin(model.Project.bill_to).where(model.Project.id == project_id, model.Project.archived_at.is_(None)))).first()
+        if row is None:
+            return None
+        header_id, name, bill_to_id, *bill_to = row
+        return ProjectHeader(id=header_id, name=name, bill_to=BillToHeader(*bill_to) if bill_to_id is not None else None)
+    return services.header_cache.get((tenant_id, str(project_id)), load)
+
+
+def get_live_projects(db) -> list[model.Project]:
+    return db.execute(lambda_stmt(lambda: select(model.Project).where(model.Project.archived_at.is_(None)).limit(100))).scalars().all()
+
+
+def get_due_page(tenant_id: Optional[str], after: Optional[str]) -> read_models.DuePage:
+    try:
+        cursor = read_models.parse_due_cursor(after) if after is not None else None
+    except ValueError:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, detail="Invalid cursor")
+    today = date.today()
+    until = today + timedelta(days=services.settings.DUE_UPCOMING_DAYS)
+    with get_db(tenant_id, readonly=True) as db:
+        return read_models.due_page(db, today, until, after=cursor, limit=services.settings.DUE_PAGE_SIZE)
 
 
-@cbv(server)
+@cbv(router)
 class Views:
     tenant_id: Optional[str] = Depends(get_tenant_id)
 
-    @server.post("/projects", name="create_project")
-    def create_project(self, request: Request, name: str = Form()):
+    @router.post("/projects", name="create_project")
+    def create_project(self, request: Request, name: str = Form(), render: Renderable = Depends(get_templates)):
         project = model.Project(name=name)
         with get_db(self.tenant_id) as db:
             db.add(project)
-            db.commit()
+            try:
+                db.commit()
+            except sqlalchemy.exc.IntegrityError:
+                # ix_project_name_live: another live project has this name
+                db.rollback()
+                context = {"projects": get_live_projects(db), "name": name, "error": f"A project named {name!r} already exists"}
+                response = render("index.html.jinja2", context=context)
+                response.status_code = HTTPStatus.CONFLICT
+                return response
         return RedirectResponse(request.url_for("index"), status_code=HTTPStatus.SEE_OTHER)
 
 
-    @server.get("/projects/{id}", name="project_detail")
-    def project_detail(self, request: Request, id: str, render: Renderable = Depends(Templates)):
-        with get_db(self.tenant_id) as db:
-            project: model.Project = get_project(id, db)
-            available_deliverables = db.query(model.Deliverable).outerjoin(
-                (model.InvoiceLineItem, model.Deliverable.id == model.InvoiceLineItem.deliverable_id)
-            ).filter(model.InvoiceLineItem.id == None)
-            context = {
-                "project": project,
-                "available_deliverables": available_deliverables,
-                "invoices": project.invoices,
-            }
-            return render("project_detail.html.jinja2", context=context)
-
-
-    @server.post("/projects/{id}/delete", name="project_delete")
+    @router.get("/projects/{id}", name="project_detail")
+    def project_detail(self, request: Request, id: str, render: Renderable = Depends(get_templates)):
+        with get_db(self.tenant_id, readonly=True) as db:
+            project = db.execute(lambda_stmt(lambda: select(model.Project).where(
+                model.Project.id == id, model.Project.archived_at.is_(None),
+            ).options(*read_models.PROJECT_VIEW_OPTIONS))).scalars().first()
+            if not project:
+                raise ValueError
+            view = read_models.project_view(project)
+            header = get_project_header(self.tenant_id, id, db)
+        context = {
+            "project": view,
+            "header": header,
+            "available_deliverables": tuple(d for d in view.deliverables if not d.invoiced),
+            "invoices": view.invoices,
+        }
+        if services.settings.STREAM_PROJECT_DETAIL:
+            return render_stream(request, "project_detail.html.jinja2", context)
+        return render("project_detail.html.jinja2", context=context)
+
+
+    @router.post("/projects/{id}/delete", name="project_delete")
     def project_delete(self, request: Request, id: str):
         with get_db(self.tenant_id) as db:
             project = get_project(id, db)
-            db.delete(project)
+            if not project:
+                raise ValueError
+            project.archive()
             db.commit()
+            services.header_cache.invalidate((self.tenant_id, id))
             return RedirectResponse(request.url_for("index"), status_code=HTTPStatus.SEE_OTHER)
 
 
-    @server.post("/project/{project_id}/deliverable", name="create_deliverable")
+    @router.post("/projects/{id}/restore", name="project_restore")
+    def project_restore(self, request: Request, id: str):
+        with get_db(self.tenant_id) as db:
+            project = db.get(model.Project, id)
+            if not project:
+                raise ValueError
+            project.restore()
+            try:
+                db.commit()
+            except sqlalchemy.exc.IntegrityError:
+                db.rollback()
+                raise HTTPException(HTTPStatus.CONFLICT, detail="A live project already has this project's name")
+            return RedirectResponse(request.url_for("archive"), status_code=HTTPStatus.SEE_OTHER)
+
+
+    @router.post("/project/{project_id}/deliverable", name="create_deliverable")
     def create_deliverable(
         self,
         project_id: str, request: Request, 
-        name: str = Form(), estimate: Decimal = Form(), due_date: Optional[date] = Form(default=None)
+        name: str = Form(), estimate: Decimal = Form(), due_date: Optional[date] = Form(default=None),
+        idempotency: Idempotency = Depends(get_idempotency),
         ):
         with get_db(self.tenant_id) as db:
+            replayed = idempotency.replay(db)
+            if replayed:
+                return replayed
             project = get_project(project_id, db)
             if not project:
                 raise ValueError
@@ -164,11 +485,10 @@ class Views:
                 created=datetime.utcnow(),
             )
             project.deliverables.append(deliverable)
-            db.commit()
-            return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
+            return idempotency.commit(db, RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER))
 
 
-    @server.post("/project/{project_id}/deliverable/{deliverable_id}/delete", name="delete_deliverable")
+    @router.post("/project/{project_id}/deliverable/{deliverable_id}/delete", name="delete_deliverable")
     def delete_deliverable(
         self,
         project_id: str, deliverable_id: str, request: Request, 
@@ -180,27 +500,69 @@ class Views:
             deliverable = project.get_deliverable(deliverable_id)
             if not deliverable:
                 raise ValueError("No deliverable")
-            project.deliverables.remove(deliverable)
-            db.delete(deliverable)
+            if deliverable.invoiced:
+                raise ValueError("Deliverable has been invoiced")
+            deliverable.archive()
             db.commit()
             return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
 
-    @server.post("/project/{project_id}/invoice", name="create_invoice")
+    @router.post("/project/{project_id}/deliverable/{deliverable_id}/restore", name="restore_deliverable")
+    def restore_deliverable(
+        self,
+        project_id: str, deliverable_id: str, request: Request, 
+        ):
+        with get_db(self.tenant_id) as db:
+            deliverable = db.query(model.Deliverable).filter_by(id=deliverable_id, project_id=project_id).first()
+            if not deliverable:
+                raise ValueError("No deliverable")
+            deliverable.restore()
+            db.commit()
+            return RedirectResponse(request.url_for("archive"), status_code=HTTPStatus.SEE_OTHER)
+
+    @router.post("/project/{project_id}/invoice", name="create_invoice")
     def create_invoice(
         self,
-        project_id: str, request: Request, name: str = Form()
+        project_id: str, request: Request, name: str = Form(), idempotency: Idempotency = Depends(get_idempotency)
         ):
         with get_db(self.tenant_id) as db:
+            replayed = idempotency.replay(db)
+            if replayed:
+                return replayed
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
             invoice = model.Invoice(project=project, name=name)
             db.add(invoice)
-            db.commit()
-            return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
+            return idempotency.commit(db, RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER))
             
 
-    @server.get("/project/{project_id}/invoice/{invoice_id}", name="invoice_detail")
+    @router.post("/project/{project_id}/invoice/{invoice_id}/archive", name="archive_invoice")
+    def archive_invoice(
+        self,
+        project_id: str, invoice_id: str, request: Request
+        ):
+        with get_db(self.tenant_id) as db:
+            invoice = db.query(model.Invoice).filter_by(id=invoice_id, project_id=project_id, archived_at=None).first()
+            if not invoice:
+                raise HTTPException(HTTPStatus.NOT_FOUND, detail="No such invoice on this project")
+            invoice.archive()
+            db.commit()
+            return RedirectResponse(request.url_for("project_detail", id=invoice.project_id), status_code=HTTPStatus.SEE_OTHER)
+
+    @router.post("/project/{project_id}/invoice/{invoice_id}/restore", name="restore_invoice")
+    def restore_invoice(
+        self,
+        project_id: str, invoice_id: str, request: Request
+        ):
+        with get_db(self.tenant_id) as db:
+            invoice = db.query(model.Invoice).filter_by(id=invoice_id, project_id=project_id).first()
+            if not invoice:
+                raise ValueError
+            invoice.restore()
+            db.commit()
+            return RedirectResponse(request.url_for("archive"), status_code=HTTPStatus.SEE_OTHER)
+
+    @router.get("/project/{project_id}/invoice/{invoice_id}", name="invoice_detail")
     def invoice_detail(
         self,
         project_id: str, invoice_id: str, request: Request
@@ -209,11 +571,11 @@ class Views:
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
-            invoice = get_invoice(invoice_id, db)
+            invoice = get_invoice(project_id, invoice_id, db)
             return RedirectResponse(request.url_for("invoice_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
 
 
-    @server.post("/project/{project_id}/invoice/{invoice_id}/line_items", name="add_line_item")
+    @router.post("/project/{project_id}/invoice/{invoice_id}/line_items", name="add_line_item")
     def add_line_item(
         self,
         project_id: str, invoice_id: str, request: Request, deliverable_id: str = Form()
@@ -222,13 +584,14 @@ class Views:
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
-            invoice: model.Invoice = get_invoice(invoice_id, db)
+            invoice: model.Invoice = get_invoice(project_id, invoice_id, db)
             deliverable = project.get_deliverable(deliverable_id)
             invoice.line_items.append(model.InvoiceLineItem(deliverable=deliverable, amount=deliverable.estimate))
+            deliverable.invoiced_at = datetime.utcnow()
             db.commit()
             return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
             
-    @server.post("/project/{project_id}/invoice/{invoice_id}/line_items/{line_item_id}", name="remove_line_item")
+    @router.post("/project/{project_id}/invoice/{invoice_id}/line_items/{line_item_id}", name="remove_line_item")
     def remove_line_item(
         self,
         project_id: str, invoice_id: str, request: Request, line_item_id: str,
@@ -237,29 +600,33 @@ class Views:
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
-            invoice: model.Invoice = get_invoice(invoice_id, db)
-            line_item = db.query(model.InvoiceLineItem).get(line_item_id)
+            invoice: model.Invoice = get_invoice(project_id, invoice_id, db)
+            line_item = db.get(model.InvoiceLineItem, line_item_id)
             invoice.line_items.remove(line_item)
+            line_item.deliverable.invoiced_at = None
             db.delete(line_item)
             db.commit()
             return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
 
-    @server.post("/project/{project_id}/invoice/{invoice_id}/credit", name="add_credit")
+    @router.post("/project/{project_id}/invoice/{invoice_id}/credit", name="add_credit")
     def add_credit(
         self,
-        project_id: str, invoice_id: str, request: Request, reason: str = Form(), amount: Decimal = Form()
+        project_id: str, invoice_id: str, request: Request, reason: str = Form(), amount: Decimal = Form(),
+        idempotency: Idempotency = Depends(get_idempotency),
         ):
         with get_db(self.tenant_id) as db:
+            replayed = idempotency.replay(db)
+            if replayed:
+                return replayed
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
-            invoice: model.Invoice = get_invoice(invoice_id, db)
+            invoice: model.Invoice = get_invoice(project_id, invoice_id, db)
             credit = model.InvoiceCredit(reason=reason, amount=amount)
             invoice.credits.append(credit)
-            db.commit()
-            return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
+            return idempotency.commit(db, RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER))
 
-    @server.post("/project/{project_id}/invoice/{invoice_id}/credit/{credit_id}", name="remove_credit")
+    @router.post("/project/{project_id}/invoice/{invoice_id}/credit/{credit_id}", name="remove_credit")
     def remove_credit(
         self,
         project_id: str, invoice_id: str, request: Request, credit_id: str,
@@ -268,29 +635,32 @@ class Views:
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
-            invoice: model.Invoice = get_invoice(invoice_id, db)
-            credit = db.query(model.InvoiceCredit).get(credit_id)
+            invoice: model.Invoice = get_invoice(project_id, invoice_id, db)
+            credit = db.get(model.InvoiceCredit, credit_id)
             invoice.credits.remove(credit)
             db.delete(credit)
             db.commit()
             return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
 
-    @server.post("/project/{project_id}/invoice/{invoice_id}/reimbursement", name="add_reimbursement")
+    @router.post("/project/{project_id}/invoice/{invoice_id}/reimbursement", name="add_reimbursement")
     def add_reimbursement(
         self,
-        project_id: str, invoice_id: str, request: Request, reason: str = Form(), amount: Decimal = Form()
+        project_id: str, invoice_id: str, request: Request, reason: str = Form(), amount: Decimal = Form(),
+        idempotency: Idempotency = Depends(get_idempotency),
         ):
         with get_db(self.tenant_id) as db:
+            replayed = idempotency.replay(db)
+            if replayed:
+                return replayed
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
-            invoice: model.Invoice = get_invoice(invoice_id, db)
+            invoice: model.Invoice = get_invoice(project_id, invoice_id, db)
             reimbursement = model.InvoiceReimbursement(reason=reason, amount=amount)
             invoice.reimbursements.append(reimbursement)
-            db.commit()
-            return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
+            return idempotency.commit(db, RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER))
 
-    @server.post("/project/{project_id}/invoice/{invoice_id}/reimbursement/{reimbursement_id}", name="remove_reimbursement")
+    @router.post("/project/{project_id}/invoice/{invoice_id}/reimbursement/{reimbursement_id}", name="remove_reimbursement")
     def remove_reimbursement(
         self,
         project_id: str, invoice_id: str, request: Request, reimbursement_id: str,
@@ -299,27 +669,71 @@ class Views:
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
-            invoice: model.Invoice = get_invoice(invoice_id, db)
-            reimbursement = db.query(model.InvoiceReimbursement).get(reimbursement_id)
+            invoice: model.Invoice = get_invoice(project_id, invoice_id, db)
+            reimbursement = db.get(model.InvoiceReimbursement, reimbursement_id)
             invoice.reimbursements.remove(reimbursement)
             db.delete(reimbursement)
             db.commit()
             return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
 
 
-    @server.get("/", name="index")
-    def index(self, request: Request, render: Renderable = Depends(Templates)):
-        with get_db(self.tenant_id) as db:
-            projects = db.query(model.Project).limit(100).all()
-            context = {"request": request, "projects": projects}
+    @router.get("/", name="index")
+    def index(self, request: Request, render: Renderable = Depends(get_templates)):
+        with get_db(self.tenant_id, readonly=True) as db:
+            context = {"request": request, "projects": get_live_projects(db)}
             return render("index.html.jinja2", context=context)
 
-    @server.post("/project/{project_id}/contact", name="update_contact") 
-    def update_contact(self, project_id: str, request: Request, company_name: str = Form(), contact_name: str = Form(), contact_email: str = Form()):
+    @router.get("/backup", name="backup")
+    def download_backup(self):
+        # creates the tenant's database if this is their first request
+        services.db_proxy.get_session(tenant_id=self.tenant_id).close()
+        source = services.db_proxy.database_file(self.tenant_id)
+        chunks = backup.snapshot_stream(source, pages=services.settings.BACKUP_PAGES_PER_STEP, sleep=services.settings.BACKUP_STEP_SLEEP)
+        filename = backup.snapshot_filename("deliverables")
+        return StreamingResponse(
+            chunks, media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
+
+    @router.get("/due", name="due")
+    def due(self, request: Request, after: Optional[str] = None, render: Renderable = Depends(get_templates)):
+        page = get_due_page(self.tenant_id, after)
+        context = {"deliverables": page.deliverables, "next": page.next, "days": services.settings.DUE_UPCOMING_DAYS}
+        return render("due.html.jinja2", context=context)
+
+    @router.get("/due.json", name="due_json")
+    def due_json(self, after: Optional[str] = None):
+        page = get_due_page(self.tenant_id, after)
+        return {
+            "deliverables": [
+                {**d._asdict(), "value": str(d.value) if d.value is not None else None} for d in page.deliverables
+            ],
+            "next": page.next,
+        }
+
+    @router.get("/archive", name="archive")
+    def archive(self, request: Request, render: Renderable = Depends(get_templates)):
+        with get_db(self.tenant_id, readonly=True) as db:
+            context = {
+                "projects": db.query(model.Project).filter(model.Project.archived_at.isnot(None))
+                    .order_by(model.Project.archived_at.desc()).all(),
+                "deliverables": db.query(model.Deliverable).filter(model.Deliverable.archived_at.isnot(None))
+                    .options(joinedload(model.Deliverable.project)).order_by(model.Deliverable.archived_at.desc()).all(),
+                "invoices": db.query(model.Invoice).filter(model.Invoice.archived_at.isnot(None))
+                    .options(joinedload(model.Invoice.project)).order_by(model.Invoice.archived_at.desc()).all(),
+            }
+            return render("archive.html.jinja2", context=context)
+
+    @router.post("/project/{project_id}/contact", name="update_contact") 
+    def update_contact(
+        self, project_id: str, request: Request, company_name: str = Form(), contact_name: str = Form(), contact_email: str = Form(),
+        version: Optional[int] = Form(None),
+        ):
         with get_db(self.tenant_id) as db:
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
+            check_version(project, version)
             bill_to = project.bill_to
             if not bill_to:
                 bill_to = model.BillTo(company_name=company_name, contact_name=contact_name, contact_email=contact_email)
@@ -329,54 +743,68 @@ class Views:
                 bill_to.company_name = company_name
                 bill_to.contact_name = contact_name
                 bill_to.contact_email = contact_email
+                # the contact is part of the project, so editing it bumps the project's version
+                flag_modified(project, "bill_to_id")
             db.commit()
+            services.header_cache.invalidate((self.tenant_id, project_id))
             return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
 
-    @server.get("/project/{project_id}/invoice/{invoice_id}/render", name="render_invoice")
-    def render_invoice(self, request: Request, project_id: str, invoice_id: str, render: Renderable = Depends(Templates)):
-        with get_db(self.tenant_id) as db:
-            project: model.Project = get_project(project_id, db)
-            if not project:
+    @router.get("/project/{project_id}/invoice/{invoice_id}/render", name="render_invoice")
+    def render_invoice(self, request: Request, project_id: str, invoice_id: str, render: Renderable = Depends(get_templates)):
+        with get_db(self.tenant_id, readonly=True) as db:
+            header = get_project_header(self.tenant_id, project_id, db)
+            if not header:
                 raise ValueError
-            invoice: model.Invoice = get_invoice(invoice_id, db)
-            context = {
-                "date": date.today().strftime("%b %d, %Y"),
-                "bill_to": project.bill_to,
-                "invoice_number": invoice.name,
-                "deliverables": invoice.line_items,
-                "reimbursements": invoice.reimbursements,
-                "credits": invoice.credits,
-                "balance_due": invoice.balance_due,
-                "reimbursements_total": invoice.reimbursements_total,
-                "net_pay": invoice.net_pay,
-            }
-            return render("invoice.html.jinja2", context=context)
-
-
-    @server.post("/project/{project_id}/invoice/{invoice_id}/sent", name="invoice_sent")
-    def invoice_sent(self, request: Request, project_id: str, invoice_id: str, sent: Optional[date] = Form(None)):
+            invoice = db.execute(lambda_stmt(lambda: select(model.Invoice).where(
+                model.Invoice.id == invoice_id, model.Invoice.project_id == project_id, model.Invoice.archived_at.is_(None),
+            ).options(*read_models.INVOICE_VIEW_OPTIONS))).scalars().first()
+            if invoice is None:
+                raise HTTPException(HTTPStatus.NOT_FOUND, detail="No such invoice on this project")
+            view = read_models.invoice_view(invoice)
+        context = {
+            "date": date.today().strftime("%b %d, %Y"),
+            "bill_to": header.bill_to,
+            "invoice_number": view.name,
+            "deliverables": view.line_items,
+            "reimbursements": view.reimbursements,
+            "credits": view.credits,
+            "totals": view.totals,
+        }
+        return render("invoice.html.jinja2", context=context)
+
+
+    @router.post("/project/{project_id}/invoice/{invoice_id}/sent", name="invoice_sent")
+    def invoice_sent(
+        self, request: Request, project_id: str, invoice_id: str, sent: Optional[date] = Form(None),
+        version: Optional[int] = Form(None),
+        ):
         with get_db(self.tenant_id) as db:
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
-            invoice: model.Invoice = get_invoice(invoice_id, db)
+            invoice: model.Invoice = get_invoice(project_id, invoice_id, db)
+            check_version(invoice, version)
             invoice.sent = sent
             db.commit()
             return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
 
 
-    @server.post("/project/{project_id}/invoice/{invoice_id}/paid", name="invoice_paid")
-    def invoice_paid(self, request: Request, project_id: str, invoice_id: str, paid: Optional[date] = Form(None)):
+    @router.post("/project/{project_id}/invoice/{invoice_id}/paid", name="invoice_paid")
+    def invoice_paid(
+        self, request: Request, project_id: str, invoice_id: str, paid: Optional[date] = Form(None),
+        version: Optional[int] = Form(None),
+        ):
         with get_db(self.tenant_id) as db:
             project: model.Project = get_project(project_id, db)
             if not project:
                 raise ValueError
-            invoice: model.Invoice = get_invoice(invoice_id, db)
+            invoice: model.Invoice = get_invoice(project_id, invoice_id, db)
+            check_version(invoice, version)
             invoice.paid = paid
             db.commit()
             return RedirectResponse(request.url_for("project_detail", id=project.id), status_code=HTTPStatus.SEE_OTHER)
 
-    @server.get("/db-limit-exceeded")
+    @router.get("/db-limit-exceeded")
     def db_limit_exceeded_confirmation(self):
         html = """
         <h1>It looks like you've added too much data to your database!</h1>
@@ -388,10 +816,11 @@ class Views:
         """
         return HTMLResponse(html)
     
-    @server.post("/db-limit-exceeded")
+    @router.post("/db-limit-exceeded")
     def wipe_database(self):
-        if not isinstance(db_proxy, model.MultitenantDatabaseProxy):
+        if not isinstance(services.db_proxy, model.MultitenantDatabaseProxy):
             raise UnsupportedOperation()
         else:
-            db_proxy.recreate_database(self.tenant_id)
+            services.db_proxy.recreate_database(self.tenant_id)
+            services.header_cache.invalidate_tenant(self.tenant_id)
         return RedirectResponse("/", status_code=303)
@@ -0,0 +1,161 @@
+"""Fingerprinted, precompressed static files, served ahead of the app's middleware.
+
+Everything under the static directory is read and hashed once at startup.
+`url("css/main.css")` gives `/static/css/main.<hash>.css`, which is served with an
+immutable Cache-Control since its content can never change under that name.
+Each file is kept gzipped (and brotli'd, when the `brotli` package is installed)
+so requests only pick a variant, by their Accept-Encoding q-values. Each variant has
+its own ETag, since their bytes differ.
+"""
+import gzip
+import hashlib
+import mimetypes
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from starlette.responses import PlainTextResponse, Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+# preferred first when a client accepts several equally
+COMPRESSED_ENCODINGS = ("br", "gzip")
+
+
+class Asset(NamedTuple):
+    media_type: str
+    digest: str
+    # content-encoding -> body, "identity" always present
+    variants: dict
+
+    def etag(self, encoding: str) -> str:
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+
+def parse_accept_encoding(header: str) -> dict[str, float]:
+    """`gzip;q=0.5, br` -> {"gzip": 0.5, "br": 1.0}, leaving out codings with a malformed q"""
+    codings = {}
+    for item in header.split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = -1.0
+        if 0.0 <= q <= 1.0:
+            coding = coding.lower()
+            codings["gzip" if coding == "x-gzip" else coding] = q
+    return codings
+
+
+def choose_encoding(accept_encoding: str, available) -> str:
+    """The accepted variant with the highest q, compressed ones winning ties"""
+    codings = parse_accept_encoding(accept_encoding)
+    anything = codings.get("*", 0.0)
+    # only competes when listed, identity is what's sent when nothing else is acceptable anyway
+    identity = codings.get("identity", 0.0)
+
+    def q(encoding: str) -> float:
+        return codings.get(encoding, anything)
+
+    accepted = [e for e in COMPRESSED_ENCODINGS if e in available and q(e) > 0]
+    best = max(accepted, key=q, default=None)
+    if best is not None and q(best) >= identity:
+        return best
+    return "identity"
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    return any(
+        candidate == "*" or candidate.removeprefix("W/") == etag
+        for candidate in (c.strip() for c in if_none_match.split(","))
+    )
+
+
+class StaticAssets:
+    def __init__(self, directory: Path, prefix: str = "/static"):
+        self._prefix = prefix
+        self._assets: dict[str, Asset] = {}
+        self._fingerprinted: dict[str, str] = {}
+        self._urls: dict[str, str] = {}
+        for filepath in sorted(p for p in directory.rglob("*") if p.is_file()):
+            self._add(filepath.relative_to(directory).as_posix(), filepath.read_bytes())
+
+    def _add(self, name: str, content: bytes):
+        digest = hashlib.sha256(content).hexdigest()
+        stem, dot, suffix = name.rpartition(".")
+        fingerprinted = f"{stem}.{digest[:12]}.{suffix}" if dot else f"{name}.{digest[:12]}"
+        variants = {"identity": content}
+        compressed = gzip.compress(content, compresslevel=9, mtime=0)
+        if len(compressed) < len(content):
+            variants["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(content)
+            if len(compressed) < len(content):
+                variants["br"] = compressed
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self._assets[name] = Asset(media_type=media_type, digest=digest[:32], variants=variants)
+        self._fingerprinted[fingerprinted] = name
+        self._urls[name] = f"{self._prefix}/{fingerprinted}"
+
+    def url(self, name: str) -> str:
+        """Jinja global: the fingerprinted URL for `name`, or the plain one if there's no such file"""
+        return self._urls.get(name, f"{self._prefix}/{name}")
+
+    def matches(self, path: str) -> bool:
+        return path.startswith(self._prefix + "/")
+
+    def response(self, path: str, method: str, accept_encoding: str, if_none_match: Optional[str]) -> Response:
+        if method not in ("GET", "HEAD"):
+            return PlainTextResponse("Method Not Allowed", status_code=405)
+        name = path[len(self._prefix) + 1:]
+        cache_control = IMMUTABLE
+        if name in self._fingerprinted:
+            name = self._fingerprinted[name]
+        else:
+            cache_control = REVALIDATE
+        asset = self._assets.get(name)
+        if asset is None:
+            return PlainTextResponse("Not Found", status_code=404)
+        encoding = choose_encoding(accept_encoding, asset.variants)
+        etag = asset.etag(encoding)
+        headers = {"Cache-Control": cache_control, "ETag": etag, "Vary": "Accept-Encoding"}
+        if if_none_match is not None and _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        body = asset.variants[encoding]
+        if method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(body, headers=headers, media_type=asset.media_type)
+
+
+class StaticAssetsMiddleware:
+    """Answers static requests itself, skipping auth and the database middleware entirely"""
+    def __init__(self, app: ASGIApp, assets: StaticAssets):
+        self.app = app
+        self.assets = assets
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self.assets.matches(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        response = self.assets.response(
+            scope["path"],
+            scope["method"],
+            accept_encoding=headers.get(b"accept-encoding", b"").decode("latin-1"),
+            if_none_match=headers.get(b"if-none-match", b"").decode("latin-1") or None,
+        )
+        await response(scope, receive, send)
@@ -11,6 +11,7 @@ from fastapi.responses import RedirectResponse, HTMLResponse
 
 
 from .exceptions import Unauthorized
+from .utils import is_valid_tenant_id
 
 
 class AuthInterface:
@@ -30,6 +31,10 @@ class AuthInterface:
     def is_authenticated(self, request: Request):
         pass
 
+    def finish_response(self, request: Request, response: Response):
+        """Called with every authenticated request's response"""
+        pass
+
     def get_tenant_id(self, request: Request):
         return None
 
@@ -44,22 +49,38 @@ class NoopAuth(AuthInterface):
 
 
 class MultitenantAuth(AuthInterface):
-    def __init__(self, server) -> None:
+    """Every visitor is a tenant, identified by a signed random id in their cookie.
+
+    A visitor without a valid cookie gets a new id, and the cookie rides on the
+    response to that same request instead of a redirect. Only reads get one: a
+    write has to come with a cookie from an earlier response, otherwise a client
+    that drops its cookie would get a new tenant, file and quota on every POST.
+    """
+    NEW_SESSION_METHODS = ("GET", "HEAD")
+
+    def __init__(self, secret_key: str, server) -> None:
+        if not secret_key:
+            raise RuntimeError("SECRET_KEY must be set to sign demo session ids")
         self._cookie_name = "demo_auth"
+        self._signer = Signer(secret_key=secret_key)
         super().__init__(server)
 
     def is_authenticated(self, request: Request):
-        cookie = request.cookies.get(self._cookie_name)
-        if not cookie:
-            session_id  = self._generate_session_id()
-            response = RedirectResponse(request.url, status_code=303)
-            response.set_cookie(self._cookie_name, session_id)
-            raise Unauthorized(response)
+        tenant_id = self._signer.unsign(request.cookies.get(self._cookie_name))
+        if not is_valid_tenant_id(tenant_id):
+            if request.method not in self.NEW_SESSION_METHODS:
+                raise Unauthorized(RedirectResponse("/", status_code=303))
+            tenant_id = self._generate_session_id()
+            request.state.new_session = True
+        request.state.tenant_id = tenant_id
         return True
-    
+
+    def finish_response(self, request: Request, response: Response):
+        if getattr(request.state, "new_session", False):
+            response.set_cookie(self._cookie_name, self._signer.sign(request.state.tenant_id), httponly=True, samesite="lax")
+
     def get_tenant_id(self, request: Request):
-        tenant_id = request.cookies[self._cookie_name]
-        return tenant_id
+        return request.state.tenant_id
     
     def _generate_session_id(self) -> str:
         return secrets.token_hex(24)
@@ -137,6 +158,17 @@ class Signer:
         token_bytes = token_str.encode("utf-8")
         return base64.b64encode(token_bytes).decode("utf-8")
     
+    def sign(self, value: str) -> str:
+        return f"{value}.{self._digest_value(value)}"
+
+    def unsign(self, signed: Optional[str]) -> Optional[str]:
+        """The value `sign` was given, or None if `signed` wasn't made by us"""
+        value, _, digest = (signed or "").rpartition(".")
+        # a sha256 hexdigest, so malformed cookies never cost an HMAC
+        if len(digest) != 64 or not hmac.compare_digest(digest, self._digest_value(value)):
+            return None
+        return value
+
     def check_token(self, token: str) -> bool:
         if token:
             token_bytes = base64.b64decode(token)
@@ -0,0 +1,129 @@
+"""Consistent snapshots of live databases through the sqlite online backup API.
+
+    python -m src.backup snapshot [--output DIR] [--tenants]
+    python -m src.backup restore SNAPSHOT [--tenant ID]
+
+The backup copies a few pages per step and sleeps between steps with the GIL
+released, so the app keeps serving requests while it runs. Snapshots are gzipped.
+"""
+import argparse
+import gzip
+import shutil
+import sqlite3
+import sys
+import tempfile
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _connect_readonly(path: Path) -> sqlite3.Connection:
+    # a plain connect() would create an empty database if the file is missing
+    return sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+
+
+def snapshot(source: Path, destination: Path, pages: int = 256, sleep: float = 0.005):
+    src = _connect_readonly(source)
+    dst = sqlite3.connect(destination)
+    try:
+        src.backup(dst, pages=pages, sleep=sleep)
+    finally:
+        dst.close()
+        src.close()
+
+
+def _gzip_chunks(path: Path) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            if data := compressor.compress(chunk):
+                yield data
+    yield compressor.flush()
+
+
+def snapshot_stream(source: Path, pages: int = 256, sleep: float = 0.005) -> Iterator[bytes]:
+    """Gzipped snapshot of `source`, for a StreamingResponse"""
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = Path(tmp) / source.name
+        snapshot(source, copy, pages=pages, sleep=sleep)
+        yield from _gzip_chunks(copy)
+
+
+def snapshot_filename(name: str) -> str:
+    return f"{name}-{datetime.utcnow():%Y%m%dT%H%M%S}.db.gz"
+
+
+def write_snapshot(source: Path, directory: Path, pages: int = 256, sleep: float = 0.005) -> Path:
+    directory.mkdir(parents=True, exist_ok=True)
+    target = directory / snapshot_filename(source.stem)
+    partial = target.with_name(target.name + ".partial")
+    with open(partial, "wb") as f:
+        for chunk in snapshot_stream(source, pages=pages, sleep=sleep):
+            f.write(chunk)
+    partial.rename(target)
+    return target
+
+
+def restore(snapshot_path: Path, destination: Path, pages: int = 256, sleep: float = 0.005):
+    """Copy a snapshot (gzipped or not) into `destination`, which may be in use"""
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = Path(tmp) / "restore.db"
+        opener = gzip.open if snapshot_path.suffix == ".gz" else open
+        with opener(snapshot_path, "rb") as f, open(copy, "wb") as out:
+            shutil.copyfileobj(f, out, CHUNK_SIZE)
+        src = _connect_readonly(copy)
+        try:
+            (result,) = src.execute("PRAGMA quick_check").fetchone()
+            if result != "ok":
+                raise ValueError(f"Snapshot {snapshot_path} failed integrity check: {result}")
+            dst = sqlite3.connect(destination)
+            try:
+                src.backup(dst, pages=pages, sleep=sleep)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+
+
+def main(argv=None):
+    from . import model
+    from .settings import Settings
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    snapshot_parser = subcommands.add_parser("snapshot")
+    snapshot_parser.add_argument("--output", type=Path, default=Path("backups"))
+    snapshot_parser.add_argument("--tenants", action="store_true", help="snapshot every demo tenant in DATABASE_DIRECTORY")
+    restore_parser = subcommands.add_parser("restore")
+    restore_parser.add_argument("snapshot", type=Path)
+    restore_parser.add_argument("--tenant", default=None, help="demo tenant id to restore into")
+    args = parser.parse_args(argv)
+
+    settings = Settings()
+    step = {"pages": settings.BACKUP_PAGES_PER_STEP, "sleep": settings.BACKUP_STEP_SLEEP}
+
+    def tenant_storage() -> model.MultitenantDatabaseStorageManager:
+        return model.MultitenantDatabaseStorageManager(settings.DATABASE_DIRECTORY)
+
+    if args.command == "snapshot":
+        if args.tenants:
+            sources = tenant_storage().database_files()
+        else:
+            sources = model.StaticDatabaseProxy(settings=settings).database_files()
+        for source in sources:
+            print(write_snapshot(source, args.output, **step))
+    else:
+        if args.tenant is not None:
+            destination = tenant_storage()._filepath_for_database(args.tenant)
+        else:
+            destination = model.StaticDatabaseProxy(settings=settings).database_file()
+        restore(args.snapshot, destination, **step)
+        print(f"Restored {args.snapshot} into {destination}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
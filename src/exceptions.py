@@ -11,4 +11,18 @@ class RefreshDatabaseError(Exception):
 
 
 class DatabaseLimitExceededError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class DatabaseBusyError(Exception):
+    pass
+
+
+class DatabaseConflictError(Exception):
+    pass
+
+
+class QuotaExceededError(Exception):
+    def __init__(self, retry_after: float = 1.0, *args: object) -> None:
+        self.retry_after = retry_after
+        super().__init__(*args)
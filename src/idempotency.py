@@ -0,0 +1,84 @@
+"""Idempotency keys: a retried or double-submitted POST gets the original response instead of writing twice.
+
+Forms carry a hidden `idempotency_key` minted when the page rendered, other clients
+send an `Idempotency-Key` header. The key is saved in the tenant's own database in
+the same transaction as the write, so either both commit or neither does. A key is
+honoured for `ttl` seconds, maintenance deletes it some time after. Reusing one for
+another path or other form values is a conflict.
+"""
+import hashlib
+import re
+import secrets
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from typing import Iterable, Optional
+
+import sqlalchemy
+from fastapi import HTTPException
+from fastapi.responses import RedirectResponse
+from sqlalchemy import delete, lambda_stmt, select
+from sqlalchemy.orm import Session
+
+from . import model
+
+KEY_PATTERN = re.compile(r"[A-Za-z0-9_-]{16,64}")
+
+
+def new_key() -> str:
+    """Jinja global: a fresh key for a form"""
+    return secrets.token_urlsafe(16)
+
+
+def fingerprint(fields: Iterable[tuple[str, str]]) -> str:
+    """Of a request's form fields, in any order, leaving out the key itself"""
+    digest = hashlib.sha256()
+    for name, value in sorted((name, str(value)) for name, value in fields if name != "idempotency_key"):
+        digest.update(f"{len(name)}:{name}{len(value)}:{value}".encode())
+    return digest.hexdigest()
+
+
+class Idempotency:
+    def __init__(self, key: Optional[str], path: str, ttl: float, fingerprint: Optional[str] = None):
+        if key is not None and not KEY_PATTERN.fullmatch(key):
+            raise ValueError("Invalid idempotency key")
+        self.key = key
+        self.path = path
+        self.ttl = ttl
+        self.fingerprint = fingerprint
+
+    def replay(self, db: Session) -> Optional[RedirectResponse]:
+        """The response of the request that already used this key, if any"""
+        key = self.key
+        if key is None:
+            return None
+        # columns only, on every keyed POST: half the cost of loading the entity with Session.get
+        row = db.execute(lambda_stmt(lambda: select(
+            model.IdempotencyKey.path, model.IdempotencyKey.status_code,
+            model.IdempotencyKey.location, model.IdempotencyKey.fingerprint, model.IdempotencyKey.created,
+        ).where(model.IdempotencyKey.key == key))).first()
+        if row is None:
+            return None
+        path, status_code, location, fingerprint, created = row
+        if created < datetime.utcnow() - timedelta(seconds=self.ttl):
+            db.execute(delete(model.IdempotencyKey).where(model.IdempotencyKey.key == key))
+            return None
+        if path != self.path or fingerprint != self.fingerprint:
+            raise HTTPException(HTTPStatus.CONFLICT, detail="Idempotency key was used for a different request")
+        return RedirectResponse(location, status_code=status_code)
+
+    def commit(self, db: Session, response: RedirectResponse) -> RedirectResponse:
+        """Commit the write along with the key, or return the response of a concurrent request that won"""
+        if self.key is not None:
+            db.add(model.IdempotencyKey(
+                key=self.key, path=self.path, status_code=response.status_code, location=response.headers["location"],
+                fingerprint=self.fingerprint,
+            ))
+        try:
+            db.commit()
+        except sqlalchemy.exc.IntegrityError:
+            db.rollback()
+            replayed = self.replay(db)
+            if replayed is None:
+                raise
+            return replayed
+        return response
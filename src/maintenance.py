@@ -0,0 +1,170 @@
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+from . import model
+
+logger = logging.getLogger(__name__)
+
+
+class MaintenanceScheduler:
+    """Runs sqlite housekeeping on a background thread, so requests never pay for it.
+
+    Each pass visits every database the proxy knows about that changed since the last
+    pass and runs `PRAGMA incremental_vacuum`, `ANALYZE` and a WAL checkpoint.
+    `page_budget` caps the pages vacuumed per pass across all files, and `pause`
+    spaces out the files, so a pass never hogs the disk. A file created before
+    incremental vacuum was switched on is converted with one full VACUUM, paid for out
+    of the same budget. Demo tenant files neither written nor visited
+    for `idle_tenant_seconds` are deleted, and so are idempotency keys older than
+    `idempotency_key_ttl`. Visits are recorded by the proxy touching the file, see
+    `MultitenantDatabaseProxy.TOUCH_INTERVAL`, so a touched file is maintained once too.
+    """
+    def __init__(
+        self,
+        db_proxy: model.DatabaseProxy,
+        interval: float,
+        page_budget: int,
+        pause: float = 0.0,
+        idle_tenant_seconds: Optional[float] = None,
+        busy_timeout: float = 0.1,
+        idempotency_key_ttl: Optional[float] = None,
+    ):
+        self._db_proxy = db_proxy
+        self._interval = interval
+        self._page_budget = page_budget
+        self._pause = pause
+        self._idle_tenant_seconds = idle_tenant_seconds
+        self._busy_timeout = busy_timeout
+        self._idempotency_key_ttl = idempotency_key_ttl
+        self._last_pass = 0.0
+        # busy last time, visited whether or not they changed since
+        self._retry: set[Path] = set()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="db-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Database maintenance pass failed")
+
+    def run_once(self) -> dict:
+        started = time.time()
+        stats = {"visited": 0, "skipped": 0, "pages_vacuumed": 0, "deleted": 0}
+        budget = self._page_budget
+        for filepath in self._db_proxy.database_files():
+            if self._stopped.is_set():
+                break
+            mtime = self._last_used(filepath)
+            if mtime is None:
+                continue
+            if self._is_abandoned(mtime, started):
+                logger.info("Deleting idle tenant database %s", filepath.name)
+                self._db_proxy.delete_database(filepath.stem)
+                stats["deleted"] += 1
+                continue
+            if mtime < self._last_pass and filepath not in self._retry:
+                # neither written nor visited since we last looked
+                continue
+            try:
+                vacuumed = self._maintain(filepath, budget)
+            except sqlite3.OperationalError as e:
+                # busy serving a request, it'll still be dirty next pass
+                logger.info("Skipping maintenance of %s: %s", filepath.name, e)
+                stats["skipped"] += 1
+                self._retry.add(filepath)
+                continue
+            self._retry.discard(filepath)
+            budget -= vacuumed
+            stats["pages_vacuumed"] += vacuumed
+            stats["visited"] += 1
+            if self._pause:
+                self._stopped.wait(self._pause)
+        self._last_pass = started
+        logger.info("Database maintenance pass took %.2fs: %s", time.time() - started, stats)
+        return stats
+
+    @staticmethod
+    def _last_used(filepath: Path) -> Optional[float]:
+        """The file's mtime, written or touched by a visit.
+
+        A WAL database's commits land in its `-wal` file until a checkpoint, so that counts too.
+        """
+        try:
+            mtime = filepath.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        try:
+            return max(mtime, filepath.with_name(f"{filepath.name}-wal").stat().st_mtime)
+        except FileNotFoundError:
+            return mtime
+
+    def _is_abandoned(self, mtime: float, now: float) -> bool:
+        return (
+            self._idle_tenant_seconds is not None
+            and isinstance(self._db_proxy, model.MultitenantDatabaseProxy)
+            and now - mtime > self._idle_tenant_seconds
+        )
+
+    def _maintain(self, filepath: Path, budget: int) -> int:
+        """Returns how many pages were vacuumed"""
+        con = sqlite3.connect(filepath, timeout=self._busy_timeout, isolation_level=None)
+        try:
+            vacuumed = 0
+            if self._idempotency_key_ttl is not None:
+                # first, so the pages it frees are vacuumed in the same pass
+                self._expire_idempotency_keys(con)
+            (auto_vacuum,) = con.execute("PRAGMA auto_vacuum").fetchone()
+            (freelist_count,) = con.execute("PRAGMA freelist_count").fetchone()
+            if auto_vacuum == 0 and budget > 0:
+                vacuumed = self._enable_incremental_vacuum(con, filepath, budget)
+            elif auto_vacuum == 2 and freelist_count and budget > 0:
+                vacuumed = min(freelist_count, budget)
+                # execute() stops after the first page, executescript() steps the pragma to completion
+                con.executescript(f"PRAGMA incremental_vacuum({vacuumed});")
+            # not `PRAGMA optimize`: before sqlite 3.46 it only looks at tables this connection
+            # queried, which here is none. The limit keeps it a sample on large tables.
+            con.execute("PRAGMA analysis_limit = 1000")
+            con.execute("ANALYZE")
+            (journal_mode,) = con.execute("PRAGMA journal_mode").fetchone()
+            if journal_mode == "wal":
+                con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            return vacuumed
+        finally:
+            con.close()
+
+    def _enable_incremental_vacuum(self, con: sqlite3.Connection, filepath: Path, budget: int) -> int:
+        """auto_vacuum only changes with a VACUUM, which rewrites every page"""
+        (page_count,) = con.execute("PRAGMA page_count").fetchone()
+        if page_count > budget:
+            logger.info("%s needs %d pages to switch to incremental vacuum, over this pass's budget", filepath.name, page_count)
+            return 0
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("VACUUM")
+        logger.info("Switched %s to incremental vacuum", filepath.name)
+        return page_count
+
+    def _expire_idempotency_keys(self, con: sqlite3.Connection):
+        if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'idempotency_key'").fetchone() is None:
+            # not migrated yet
+            return
+        # the format sqlalchemy stores DATETIME in, so the strings compare in time order
+        cutoff = (datetime.utcnow() - timedelta(seconds=self._idempotency_key_ttl)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        con.execute("DELETE FROM idempotency_key WHERE created < ?", (cutoff,))
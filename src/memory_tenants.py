@@ -0,0 +1,248 @@
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Optional
+
+import sqlalchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+from . import model
+from .exceptions import DatabaseBusyError
+from .quota import TenantQuotas
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryTenant:
+    def __init__(self, uri: str, keeper: sqlite3.Connection, busy_timeout: float, now: float):
+        self.uri = uri
+        # a memdb database lives as long as one connection to it is open
+        self.keeper = keeper
+        self.busy_timeout = busy_timeout
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.last_used = now
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.uri, uri=True, timeout=self.busy_timeout, check_same_thread=False)
+
+
+class InMemoryMultitenantDatabaseProxy(model.MultitenantDatabaseProxy):
+    """Demo tenants held in in-memory sqlite databases.
+
+    A tenant is loaded from DATABASE_DIRECTORY on its first visit. Every `persist_interval`
+    seconds tenants that committed since are copied back to their file with the backup
+    API. Tenants idle for `idle_seconds` are persisted and dropped from memory, as are the
+    least recently used beyond `max_tenants`. A crash loses at most `persist_interval`
+    seconds of writes.
+
+    The databases are opened on the `memdb` VFS rather than with `cache=shared`: shared
+    cache locks tables and fails a conflicting statement at once with SQLITE_LOCKED,
+    while memdb locks the database like a file does, so the busy timeout applies.
+    """
+    def __init__(
+        self,
+        database_directory: Path,
+        busy_timeout: float = 5.0,
+        quotas: Optional[TenantQuotas] = None,
+        persist_interval: float = 30.0,
+        idle_seconds: float = 600.0,
+        max_tenants: int = 500,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        super().__init__(database_directory, busy_timeout=busy_timeout, quotas=quotas)
+        self._persist_interval = persist_interval
+        self._idle_seconds = idle_seconds
+        self._max_tenants = max_tenants
+        self._clock = clock
+        self._tenants: dict[str, MemoryTenant] = {}
+        # dropped but still being copied to their file, a visit meanwhile takes them back
+        self._evicting: dict[str, MemoryTenant] = {}
+        # held while a tenant is loaded or dropped, so it's only ever in memory once
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get_session(self, tenant_id: Optional[str], readonly: bool = False):
+        with self._lock:
+            # its file may not exist yet, or be behind
+            readonly = readonly and tenant_id not in self._evicting
+            session = super().get_session(tenant_id, readonly=readonly)
+            tenant = self._tenants.get(tenant_id)
+            if tenant is not None:
+                tenant.last_used = self._clock()
+        return session
+
+    def _check_database_size(self, tenant_id: str) -> bool:
+        tenant = self._tenants.get(tenant_id) or self._evicting.get(tenant_id)
+        if tenant is None:
+            return super()._check_database_size(tenant_id)
+        with tenant.lock:
+            try:
+                (page_count,) = tenant.keeper.execute("PRAGMA page_count").fetchone()
+                (page_size,) = tenant.keeper.execute("PRAGMA page_size").fetchone()
+            except sqlite3.OperationalError as e:
+                # a write held the lock past the busy timeout, retried like any other request's
+                raise DatabaseBusyError() from e
+        return page_count * page_size < self._storage._max_bytes
+
+    def _create_engine(self, tenant_id: str) -> sqlalchemy.engine.Engine:
+        tenant = self._tenants.get(tenant_id) or self._evicting.get(tenant_id)
+        if tenant is None:
+            tenant = self._load(tenant_id)
+        self._tenants[tenant_id] = tenant
+        engine = create_engine("sqlite://", creator=tenant.connect, poolclass=QueuePool)
+
+        @event.listens_for(engine, "commit")
+        def mark_dirty(conn):
+            tenant.dirty = True
+
+        return engine
+
+    def _load(self, tenant_id: str) -> MemoryTenant:
+        # the leading slash makes it one database shared by every connection in the process
+        uri = f"file:/deliverables-{uuid.uuid4().hex}?vfs=memdb"
+        keeper = sqlite3.connect(uri, uri=True, timeout=self._busy_timeout, check_same_thread=False)
+        filepath = self._storage._filepath_for_database(tenant_id)
+        if filepath.exists():
+            started = time.perf_counter()
+            disk = sqlite3.connect(filepath, timeout=self._busy_timeout)
+            try:
+                disk.backup(keeper)
+            finally:
+                disk.close()
+            logger.info("Loaded tenant %s into memory in %.1fms", tenant_id, (time.perf_counter() - started) * 1000)
+        return MemoryTenant(uri, keeper, self._busy_timeout, self._clock())
+
+    def persist(self, tenant_id: str) -> bool:
+        """Copy the tenant to its file if it committed since the last copy"""
+        tenant = self._tenants.get(tenant_id) or self._evicting.get(tenant_id)
+        if tenant is None:
+            return False
+        return self._persist(tenant_id, tenant)
+
+    def _persist(self, tenant_id: str, tenant: MemoryTenant) -> bool:
+        with tenant.lock:
+            if not tenant.dirty:
+                return False
+            # cleared first: a commit that lands during the copy marks it dirty again
+            tenant.dirty = False
+            disk = sqlite3.connect(self._storage._filepath_for_database(tenant_id), timeout=self._busy_timeout)
+            try:
+                tenant.keeper.backup(disk)
+            except Exception:
+                tenant.dirty = True
+                raise
+            finally:
+                disk.close()
+        return True
+
+    def _drop(self, tenant_id: str) -> Optional[MemoryTenant]:
+        """Forget the tenant, call with the lock held"""
+        self._session_local_cache.pop(tenant_id, None)
+        engine = self._engine_cache.pop(tenant_id, None)
+        if engine is not None:
+            engine.dispose()
+        return self._tenants.pop(tenant_id, None)
+
+    def evict(self, tenant_id: str) -> bool:
+        with self._lock:
+            engine = self._engine_cache.get(tenant_id)
+            if engine is not None and engine.pool.checkedout():
+                # a request is still using it
+                return False
+            tenant = self._tenants.get(tenant_id)
+            if tenant is None:
+                return False
+            self._drop(tenant_id)
+            self._evicting[tenant_id] = tenant
+        # copied without the lock, so other tenants' requests don't wait on this file
+        try:
+            self._persist(tenant_id, tenant)
+        except Exception:
+            with self._lock:
+                if self._evicting.get(tenant_id) is tenant:
+                    del self._evicting[tenant_id]
+                    # kept in memory, the next visit gives it a new engine
+                    self._tenants.setdefault(tenant_id, tenant)
+            raise
+        with self._lock:
+            if self._evicting.get(tenant_id) is tenant:
+                del self._evicting[tenant_id]
+            if self._tenants.get(tenant_id) is tenant:
+                # visited during the copy, it stays
+                return False
+            tenant.keeper.close()
+        return True
+
+    def database_file(self, tenant_id: Optional[str]) -> Path:
+        """The tenant's file, brought up to date first"""
+        self.persist(tenant_id)
+        return super().database_file(tenant_id)
+
+    def delete_database(self, tenant_id: str):
+        with self._lock:
+            tenant = self._drop(tenant_id)
+            if tenant is not None:
+                tenant.keeper.close()
+            evicting = self._evicting.pop(tenant_id, None)
+            if evicting is not None:
+                # wait out a copy in progress, and stop one that hasn't started, or it writes the file back
+                with evicting.lock:
+                    evicting.dirty = False
+            self._storage.delete_database(tenant_id)
+
+    def recreate_database(self, tenant_id: Optional[str]):
+        super().recreate_database(tenant_id)
+        self._tenants[tenant_id].dirty = True
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="db-persistence", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread and persist every tenant still in memory"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for tenant_id in list(self._tenants):
+            # one tenant's locked or unwritable file mustn't cost the others their writes
+            try:
+                self.evict(tenant_id)
+            except Exception:
+                logger.exception("Could not persist tenant %s on shutdown", tenant_id)
+
+    def _run(self):
+        while not self._stopped.wait(self._persist_interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Persisting in-memory tenants failed")
+
+    def run_once(self) -> dict:
+        started = time.time()
+        stats = {"persisted": 0, "evicted": 0, "in_memory": 0}
+        now = self._clock()
+        with self._lock:
+            tenants = sorted(self._tenants.items(), key=lambda item: item[1].last_used)
+        over = len(tenants) - self._max_tenants
+        for index, (tenant_id, tenant) in enumerate(tenants):
+            try:
+                idle = now - tenant.last_used
+                # sessions connect lazily, so never drop a tenant that was just handed one
+                if (idle > self._idle_seconds or (index < over and idle > self._persist_interval)) and self.evict(tenant_id):
+                    stats["evicted"] += 1
+                elif self._persist(tenant_id, tenant):
+                    stats["persisted"] += 1
+            except sqlite3.Error as e:
+                # the file is locked by a backup or maintenance, the tenant stays dirty
+                logger.warning("Could not persist tenant %s: %s", tenant_id, e)
+        stats["in_memory"] = len(self._tenants)
+        logger.info("Persisting in-memory tenants took %.2fs: %s", time.time() - started, stats)
+        return stats
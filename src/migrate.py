@@ -0,0 +1,178 @@
+"""Upgrade every demo tenant database to the latest Alembic revision.
+
+    python -m src.migrate [--directory DATABASE_DIRECTORY] [--jobs N]
+
+Each file is checked and upgraded in its own worker process, so one broken file
+can't take the rest down with it. Files already at head are skipped, which also
+makes an interrupted run safe to simply start again.
+
+The app builds tenant databases with `metadata.create_all` and never stamps them.
+An unstamped file is matched against the schema every revision produces, by
+running the migrations on a scratch in-memory database, so there's nothing to
+keep up to date when a revision is added.
+"""
+import argparse
+import functools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool, StaticPool
+
+ROOT_DIR = Path(__file__).parent.parent
+MIGRATIONS_DIR = ROOT_DIR / "migrations"
+
+
+
+class MigrationResult(NamedTuple):
+    filepath: str
+    before: Optional[str]
+    after: Optional[str]
+    error: Optional[str] = None
+
+
+@functools.lru_cache()
+def script_directory() -> ScriptDirectory:
+    return ScriptDirectory(str(MIGRATIONS_DIR))
+
+
+def head_revision() -> str:
+    return script_directory().get_current_head()
+
+
+def _upgrade(connection, revision: str):
+    # no ini file: skips env.py's logging setup, which would log every step of every file
+    config = Config()
+    config.set_main_option("script_location", str(MIGRATIONS_DIR))
+    config.attributes["connection"] = connection
+    command.upgrade(config, revision)
+
+
+def schema(connection) -> frozenset:
+    """Every `table.column` and `index name` in the database, alembic's own table aside"""
+    entries = set()
+    rows = connection.exec_driver_sql(
+        "SELECT type, name FROM sqlite_master WHERE type IN ('table', 'index')"
+        " AND substr(name, 1, 7) != 'sqlite_' AND name != 'alembic_version'"
+    ).fetchall()
+    for kind, name in rows:
+        if kind == "index":
+            entries.add(f"index {name}")
+            continue
+        for column in connection.exec_driver_sql(f'PRAGMA table_info("{name}")').fetchall():
+            entries.add(f"{name}.{column[1]}")
+    return frozenset(entries)
+
+
+@functools.lru_cache()
+def revision_schemas() -> tuple[tuple[str, frozenset], ...]:
+    """Oldest first, the schema each revision leaves a new database with"""
+    revisions = [script.revision for script in reversed(list(script_directory().walk_revisions()))]
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    schemas = []
+    with engine.connect() as connection:
+        for revision in revisions:
+            _upgrade(connection, revision)
+            schemas.append((revision, schema(connection)))
+    engine.dispose()
+    return tuple(schemas)
+
+
+def infer_revision(connection) -> Optional[str]:
+    """The revision whose schema is closest to the file's, among those whose columns it all has.
+
+    None for an empty file. Extra tables and indexes are expected: `create_all` adds
+    new tables to old files.
+    """
+    actual = schema(connection)
+    if not actual:
+        return None
+    columns = frozenset(e for e in actual if not e.startswith("index "))
+    best, best_difference = None, None
+    for revision, expected in revision_schemas():
+        if not {e for e in expected if not e.startswith("index ")} <= columns:
+            continue
+        difference = len(expected ^ actual)
+        # a tie goes to the older one: the migrations are safe to run twice, but a
+        # revision that only changes data looks just like its parent
+        if best_difference is None or difference < best_difference:
+            best, best_difference = revision, difference
+    if best is None:
+        raise ValueError("schema matches no revision")
+    return best
+
+
+def migrate_database(filepath: str) -> MigrationResult:
+    """Runs in a worker process"""
+    engine = create_engine(f"sqlite:///{filepath}", poolclass=NullPool)
+    before = None
+    try:
+        with engine.connect() as connection:
+            before = MigrationContext.configure(connection).get_current_revision()
+            if before is None:
+                before = infer_revision(connection)
+                if before is None:
+                    # empty file, not a tenant database yet
+                    return MigrationResult(filepath, None, None)
+                MigrationContext.configure(connection).stamp(script_directory(), before)
+            if before == head_revision():
+                return MigrationResult(filepath, before, before)
+            _upgrade(connection, "head")
+            after = MigrationContext.configure(connection).get_current_revision()
+        return MigrationResult(filepath, before, after)
+    except Exception as e:
+        return MigrationResult(filepath, before, None, error=f"{type(e).__name__}: {e}")
+    finally:
+        engine.dispose()
+
+
+def migrate_directory(directory: Path, jobs: int, out=sys.stderr) -> list[MigrationResult]:
+    filepaths = sorted(str(p) for p in directory.glob("*.db"))
+    total = len(filepaths)
+    head = head_revision()
+    print(f"Migrating {total} tenant databases in {directory} to {head} with {jobs} workers", file=out)
+    started = time.monotonic()
+    results = []
+    upgraded = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(migrate_database, filepath) for filepath in filepaths]
+        for done, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            results.append(result)
+            if result.error:
+                print(f"FAILED {result.filepath}: {result.error}", file=out)
+            elif result.before != result.after:
+                upgraded += 1
+            if done % 100 == 0 or done == total:
+                elapsed = time.monotonic() - started
+                print(f"[{done}/{total}] {upgraded} upgraded, {elapsed:.1f}s", file=out)
+    failed = sum(1 for r in results if r.error)
+    print(f"Done: {upgraded} upgraded, {total - upgraded - failed} already current, {failed} failed", file=out)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--directory", type=Path, default=None, help="defaults to DATABASE_DIRECTORY")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args(argv)
+    directory = args.directory
+    if directory is None:
+        from .settings import Settings
+        directory = Settings().DATABASE_DIRECTORY
+    if directory is None or not directory.is_dir():
+        parser.error(f"not a directory: {directory}")
+    results = migrate_directory(directory, jobs=args.jobs)
+    return 1 if any(r.error for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
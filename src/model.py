@@ -1,44 +1,99 @@
-import itertools
+import os
+import sqlite3
+import threading
+import time
 from datetime import datetime
-from decimal import ROUND_HALF_UP, Decimal
+from decimal import Decimal
 from operator import neg
 from pathlib import Path
 from typing import Optional
 
-from sqlalchemy import DATE, DATETIME, DECIMAL, MetaData, create_engine
+from sqlalchemy import DATE, DATETIME, DECIMAL, MetaData, create_engine, event
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from .exceptions import DatabaseLimitExceededError
+from .money import InvoiceTotals, from_cents, invoice_totals, to_cents
+from .quota import TenantQuotas
 
 from .settings import Settings
+from .utils import is_valid_tenant_id
 
 metadata = MetaData()
 
+def is_database_busy(error: sqlalchemy.exc.DBAPIError) -> bool:
+    """True when sqlite gave up waiting on another connection's lock (SQLITE_BUSY/SQLITE_LOCKED)"""
+    return isinstance(error, sqlalchemy.exc.OperationalError) and "locked" in str(error.orig)
+
+
+def is_query_interrupted(error: sqlalchemy.exc.DBAPIError) -> bool:
+    """True when a progress handler cut a statement short (SQLITE_INTERRUPT)"""
+    return isinstance(error, sqlalchemy.exc.OperationalError) and "interrupted" in str(error.orig)
+
+
 class DatabaseProxy:
-    def get_session(self, tenant_id: Optional[str]):
+    def get_session(self, tenant_id: Optional[str], readonly: bool = False):
+        """`readonly` sessions may be handed out without creating the database"""
         raise NotImplementedError
     
     def recreate_database(self, tenant_id: Optional[str]):
         raise NotImplementedError
 
+    def _get_engine(self, tenant_id: Optional[str]) -> sqlalchemy.engine.Engine:
+        raise NotImplementedError
+
+    def database_files(self) -> list[Path]:
+        """The sqlite files behind this proxy, for background maintenance"""
+        raise NotImplementedError
+
+    def database_file(self, tenant_id: Optional[str]) -> Path:
+        raise NotImplementedError
+
+    def check_integrity(self, tenant_id: Optional[str]) -> bool:
+        """Run `PRAGMA quick_check`, so we only ever wipe a database that is actually corrupt"""
+        engine = self._get_engine(tenant_id)
+        try:
+            with engine.connect() as con:
+                result = con.exec_driver_sql("PRAGMA quick_check").scalars().all()
+        except sqlalchemy.exc.DatabaseError as e:
+            if is_database_busy(e):
+                # someone else holds the lock, which means the file is readable
+                return True
+            return False
+        return result == ["ok"]
+
 
 class StaticDatabaseProxy(DatabaseProxy):
     def __init__(self, settings: Settings):
         self._url = SQLALCHEMY_DATABASE_URL = settings.DATABASE_URL
         engine = create_engine(
-            SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+            SQLALCHEMY_DATABASE_URL,
+            connect_args={"check_same_thread": False, "timeout": settings.DATABASE_BUSY_TIMEOUT},
         )
         self._engine = engine
         self._session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-    def get_session(self, tenant_id: Optional[str] = None):
+    def get_session(self, tenant_id: Optional[str] = None, readonly: bool = False):
         if tenant_id is not None:
             # TODO: logger.warn
             pass
         return self._session_local()
 
+    def _get_engine(self, tenant_id: Optional[str] = None):
+        return self._engine
+
+    def database_files(self) -> list[Path]:
+        database = sqlalchemy.engine.make_url(self._url).database
+        if not database or database == ":memory:":
+            return []
+        return [Path(database)]
+
+    def database_file(self, tenant_id: Optional[str] = None) -> Path:
+        (filepath,) = self.database_files()
+        return filepath
+
 
 
 class MultitenantDatabaseStorageManager:
@@ -56,53 +111,146 @@ class MultitenantDatabaseStorageManager:
         return f"sqlite:///{db_path}"
     
     def _filepath_for_database(self, database_id: str) -> Path:
+        # the id ends up in a path, never let it be anything but hex
+        if not is_valid_tenant_id(database_id):
+            raise ValueError(f"Invalid tenant id: {database_id!r}")
         return self._directory / (database_id + ".db")
 
+    def database_exists(self, database_id: str) -> bool:
+        return self._filepath_for_database(database_id).exists()
+
+    def database_files(self) -> list[Path]:
+        return sorted(p for p in self._directory.glob("*.db") if is_valid_tenant_id(p.stem))
+
+    def touch_database(self, database_id: str):
+        """Set the file's mtime to now, so reads count as use for the idle tenant cleanup"""
+        try:
+            os.utime(self._filepath_for_database(database_id))
+        except FileNotFoundError:
+            pass
+
+    def delete_database(self, database_id: str):
+        filepath = self._filepath_for_database(database_id)
+        for suffix in ("-wal", "-shm", "-journal"):
+            filepath.with_name(filepath.name + suffix).unlink(missing_ok=True)
+        filepath.unlink(missing_ok=True)
+
     def check_database_size(self, database_id: str) -> bool:
         filepath = self._filepath_for_database(database_id)
-        db_size = filepath.stat().st_size
-        print("size", db_size, self._max_bytes)
-        return (not filepath.exists()) or db_size < self._max_bytes
+        try:
+            db_size = filepath.stat().st_size
+        except FileNotFoundError:
+            return True
+        return db_size < self._max_bytes
         
 
 class MultitenantDatabaseProxy(DatabaseProxy):
-    def __init__(self, database_directory: Path) -> None:
+    # a tenant who only reads never writes their file, so visits are recorded on it at this rate
+    TOUCH_INTERVAL = 24 * 60 * 60.0
+
+    def __init__(self, database_directory: Path, busy_timeout: float = 5.0, quotas: Optional[TenantQuotas] = None) -> None:
         self._storage = MultitenantDatabaseStorageManager(database_directory)
+        self._busy_timeout = busy_timeout
+        self._quotas = quotas
         self._engine_cache = {}
         self._session_local_cache = {}
+        self._blank_session_local = None
+        self._touched: dict[str, float] = {}
 
-    def get_session(self, tenant_id: Optional[str]):
+    def get_session(self, tenant_id: Optional[str], readonly: bool = False):
         if tenant_id is None:
             raise ValueError("tenant_id must not be None for MultitenantDatabaseProxy")
-        if not self._storage.check_database_size(tenant_id):
-            raise DatabaseLimitExceededError()
+        self._record_visit(tenant_id)
         session_local = self._session_local_cache.get(tenant_id)
+        if session_local is None and readonly and not self._storage.database_exists(tenant_id):
+            # nothing to read yet, the file is only created by the first write
+            return self._get_blank_session_local()()
+        if not self._check_database_size(tenant_id):
+            raise DatabaseLimitExceededError()
         if session_local is None:
             engine = self._get_or_create_engine(tenant_id)
-            metadata.create_all(bind=engine)
+            with engine.connect() as con:
+                # must be set before the first table exists, lets maintenance reclaim pages incrementally
+                con.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+                # left unstamped, `python -m src.migrate` tells the revision from the schema
+                metadata.create_all(bind=con)
             session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
             self._session_local_cache[tenant_id] = session_local
         return session_local()
 
-    def _get_or_create_engine(self, tenant_id: str):
+    def _record_visit(self, tenant_id: str):
+        now = time.time()
+        if now - self._touched.get(tenant_id, 0.0) < self.TOUCH_INTERVAL:
+            return
+        self._touched[tenant_id] = now
+        self._storage.touch_database(tenant_id)
+
+    def _get_blank_session_local(self):
+        """Sessions on an empty in-memory schema, for every tenant without a database yet"""
+        if self._blank_session_local is None:
+            template = sqlite3.connect(":memory:", check_same_thread=False)
+            metadata.create_all(bind=create_engine("sqlite://", creator=lambda: template))
+            template_lock = threading.Lock()
+            # a pooled connection is only ever used by one thread at a time, and each
+            # one is its own copy of the empty schema
+            engine = create_engine("sqlite://", poolclass=QueuePool, connect_args={"check_same_thread": False})
+
+            @event.listens_for(engine, "connect")
+            def copy_template(dbapi_connection, connection_record):
+                with template_lock:
+                    template.backup(dbapi_connection)
+                dbapi_connection.execute("PRAGMA query_only = ON")
+
+            self._blank_session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        return self._blank_session_local
+
+    def _check_database_size(self, tenant_id: str) -> bool:
+        return self._storage.check_database_size(tenant_id)
+
+    def _create_engine(self, tenant_id: str) -> sqlalchemy.engine.Engine:
         url = self._storage._url_for_id(tenant_id)
-        engine = self._engine_cache.setdefault(
-            tenant_id, 
-            create_engine(url, connect_args={"check_same_thread": False})
-        )
+        return create_engine(url, connect_args={"check_same_thread": False, "timeout": self._busy_timeout})
+
+    def _get_or_create_engine(self, tenant_id: str):
+        engine = self._engine_cache.get(tenant_id)
+        if engine is None:
+            engine = self._create_engine(tenant_id)
+            if self._quotas is not None:
+                self._quotas.instrument(engine, tenant_id)
+            engine = self._engine_cache.setdefault(tenant_id, engine)
         return engine
 
+    def _get_engine(self, tenant_id: Optional[str]):
+        return self._get_or_create_engine(tenant_id)
+
+    def database_files(self) -> list[Path]:
+        return self._storage.database_files()
+
+    def database_file(self, tenant_id: Optional[str]) -> Path:
+        return self._storage._filepath_for_database(tenant_id)
+
+    def delete_database(self, tenant_id: str):
+        """Forget the tenant's engine before removing its file, so nothing keeps writing to the unlinked inode"""
+        self._session_local_cache.pop(tenant_id, None)
+        engine = self._engine_cache.pop(tenant_id, None)
+        if engine is not None:
+            engine.dispose()
+        self._storage.delete_database(tenant_id)
+
     def recreate_database(self, tenant_id: Optional[str]):
         print(f"Recreating database for tenant {tenant_id}")
         engine: sqlalchemy.engine.Engine = self._get_or_create_engine(tenant_id=tenant_id)
         metadata.drop_all(bind=engine)
         metadata.create_all(bind=engine)
         con = engine.connect()
+        # the old stamp no longer describes the schema, the migrate command infers it instead
+        con.execute("DROP TABLE IF EXISTS alembic_version")
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
         con.execute("VACUUM")
         con.close()
 
 
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, text
 from sqlalchemy.orm import relationship
 
 
@@ -113,22 +261,52 @@ class BaseEntity:
 Base = declarative_base(cls=BaseEntity, metadata=metadata)
 
 
+class ArchivableModel:
+    """Soft-delete: archived rows stay in the table but are left out of every default query"""
+    archived_at = Column(DATETIME, nullable=True)
+
+    @property
+    def archived(self):
+        return self.archived_at is not None
+
+    def archive(self):
+        self.archived_at = datetime.utcnow()
+
+    def restore(self):
+        self.archived_at = None
+
+
 class BaseValueModel:
     _value: Decimal
 
+    @property
+    def cents(self) -> int:
+        return to_cents(self._value)
+
     @property
     def value(self):
-        return Decimal(self._value).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        return from_cents(self.cents)
 
 
-class Deliverable(Base, BaseValueModel):
+class Deliverable(Base, BaseValueModel, ArchivableModel):
     __tablename__ = "deliverable"
+    __table_args__ = (
+        # partial index: project pages only ever scan live deliverables
+        Index("ix_deliverable_live", "project_id", "created", sqlite_where=text("archived_at IS NULL")),
+        # everything the due list can show, in the order it shows it
+        Index(
+            "ix_deliverable_due", "due_date", "id",
+            sqlite_where=text("archived_at IS NULL AND invoiced_at IS NULL AND due_date IS NOT NULL"),
+        ),
+    )
 
     project_id = Column(Integer, ForeignKey("project.id"), nullable=False)
     name = Column(String, nullable=False)
     estimate = Column(DECIMAL, nullable=True)
     created = Column(DATETIME, nullable=False, default=datetime.utcnow)
     due_date = Column(DATE, nullable=True)
+    # mirrors `line_item`, a partial index can't look into another table
+    invoiced_at = Column(DATETIME, nullable=True)
 
     project = relationship("Project")
     line_item = relationship("InvoiceLineItem", uselist=False)
@@ -191,11 +369,15 @@ class InvoiceCredit(BaseValueModel, Base):
         return neg(self.amount)
 
 
-class Invoice(Base):
+class Invoice(Base, ArchivableModel):
     __tablename__ = "invoice"
+    __table_args__ = (
+        Index("ix_invoice_live", "project_id", sqlite_where=text("archived_at IS NULL")),
+    )
 
     project_id = Column(Integer, ForeignKey("project.id"), nullable=False)
     name = Column(String, nullable=False)
+    version = Column(Integer, nullable=False, server_default="1")
 
     line_items = relationship("InvoiceLineItem", back_populates="invoice")
     credits = relationship("InvoiceCredit", back_populates="invoice")
@@ -206,30 +388,31 @@ class Invoice(Base):
     
     project = relationship("Project")
 
+    __mapper_args__ = {"version_id_col": version}
+
     @property
-    def balance_due(self):
-        values = (
-            i.value for i in itertools.chain(self.line_items, self.credits, self.reimbursements)
+    def totals(self) -> InvoiceTotals:
+        return invoice_totals(
+            (i.cents for i in self.line_items),
+            (i.cents for i in self.credits),
+            (i.cents for i in self.reimbursements),
         )
-        return sum(values)
+
+    @property
+    def balance_due(self):
+        return from_cents(self.totals.balance_due)
 
     @property
     def gross_pay(self):
-        values = (
-            i.value for i in itertools.chain(self.line_items, self.credits, self.reimbursements)
-        )
-        return sum((value for value in values if value > 0))
+        return from_cents(self.totals.gross_pay)
     
     @property
     def reimbursements_total(self):
-        values = (
-            i.value for i in itertools.chain(self.reimbursements)
-        )
-        return sum(values)
+        return from_cents(self.totals.reimbursements_total)
         
     @property
     def net_pay(self):
-        return self.balance_due - self.reimbursements_total
+        return from_cents(self.totals.net_pay)
         
 
 class BillTo(Base):
@@ -240,16 +423,45 @@ class BillTo(Base):
     contact_email = Column(String, nullable=False)
 
 
-class Project(Base):
+class Project(Base, ArchivableModel):
     __tablename__ = "project"
+    __table_args__ = (
+        # archived projects keep their name, it only has to be unique among live ones
+        Index("ix_project_name_live", "name", unique=True, sqlite_where=text("archived_at IS NULL")),
+    )
 
-    name = Column(String, unique=True, index=True)
+    name = Column(String)
+    version = Column(Integer, nullable=False, server_default="1")
     
-    deliverables = relationship("Deliverable", back_populates="project", order_by="desc(Deliverable.created)")
-    invoices = relationship("Invoice", back_populates="project", order_by="desc(Invoice.id)")
+    deliverables = relationship(
+        "Deliverable", back_populates="project", order_by="desc(Deliverable.created)",
+        primaryjoin="and_(Project.id == Deliverable.project_id, Deliverable.archived_at.is_(None))",
+    )
+    invoices = relationship(
+        "Invoice", back_populates="project", order_by="desc(Invoice.id)",
+        primaryjoin="and_(Project.id == Invoice.project_id, Invoice.archived_at.is_(None))",
+    )
     bill_to_id = Column(Integer, ForeignKey("bill_to.id"), nullable=True)
 
     bill_to = relationship("BillTo")
 
+    __mapper_args__ = {"version_id_col": version}
+
     def get_deliverable(self, deliverable_id):
         return next((d for d in self.deliverables if str(d.id) == deliverable_id), None)
+
+
+class IdempotencyKey(Base):
+    """A POST that already ran, so a retry carrying the same key gets its response instead of writing again"""
+    __tablename__ = "idempotency_key"
+    # looked up by key only, so the key itself is the b-tree and there's no rowid to store
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    id = None
+    key = Column(String, primary_key=True)
+    path = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=False)
+    location = Column(String, nullable=False)
+    # of the form fields, so the key can't be reused for the same path with other values
+    fingerprint = Column(String, nullable=True)
+    created = Column(DATETIME, nullable=False, default=datetime.utcnow)
@@ -0,0 +1,43 @@
+"""Money as integer cents.
+
+Amounts are rounded to cents once (ROUND_HALF_UP, same as `BaseValueModel.value`
+always did) and every total after that is plain integer addition. Convert back to
+`Decimal` with `from_cents` only where something needs displaying.
+"""
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Iterable, NamedTuple
+
+ONE = Decimal(1)
+
+
+def to_cents(amount) -> int:
+    """Round to the nearest cent, halves away from zero: 10.005 -> 1001, -0.125 -> -13"""
+    return int(Decimal(amount).scaleb(2).quantize(ONE, rounding=ROUND_HALF_UP))
+
+
+def from_cents(cents: int) -> Decimal:
+    return Decimal(cents).scaleb(-2)
+
+
+class InvoiceTotals(NamedTuple):
+    balance_due: int
+    gross_pay: int
+    reimbursements_total: int
+    net_pay: int
+
+
+def invoice_totals(line_items: Iterable[int], credits: Iterable[int], reimbursements: Iterable[int]) -> InvoiceTotals:
+    """Every total an invoice needs, in one pass over its amounts (in cents)"""
+    line_items = list(line_items)
+    credits = list(credits)
+    reimbursements = list(reimbursements)
+    reimbursements_total = sum(reimbursements)
+    balance_due = sum(line_items) + sum(credits) + reimbursements_total
+    gross_pay = sum(c for c in line_items if c > 0) + sum(c for c in credits if c > 0) \
+        + sum(c for c in reimbursements if c > 0)
+    return InvoiceTotals(
+        balance_due=balance_due,
+        gross_pay=gross_pay,
+        reimbursements_total=reimbursements_total,
+        net_pay=balance_due - reimbursements_total,
+    )
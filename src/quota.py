@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import sqlalchemy
+from sqlalchemy import event
+
+from .exceptions import QuotaExceededError
+
+# sqlite calls the progress handler every this many virtual machine instructions
+PROGRESS_STEPS = 1000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Takes a token and returns 0, or returns how long until one is available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class TenantUsage:
+    def __init__(self, bucket: Optional[TokenBucket], now: float):
+        self.bucket = bucket
+        self.window_start = now
+        self.sql_time = 0.0
+
+
+class TenantQuotas:
+    """Per-tenant request rate and SQL time budgets, so one demo tenant can't starve the rest.
+
+    Requests are admitted by a token bucket refilled at `request_rate` per second.
+    Time spent in SQL, fetching rows included, is measured with engine events and a
+    sqlite progress handler and summed per `sql_window`; once a tenant has spent
+    `sql_budget` seconds, its requests are refused until the window rolls over. A
+    single statement still executing or fetching after `query_time_limit` is
+    interrupted. Any of these set to 0 is disabled.
+    """
+    def __init__(
+        self,
+        request_rate: float,
+        request_burst: int,
+        sql_budget: float,
+        sql_window: float,
+        query_time_limit: float,
+        max_tenants: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._request_rate = request_rate
+        self._request_burst = request_burst
+        self._sql_budget = sql_budget
+        self._sql_window = sql_window
+        self._query_time_limit = query_time_limit
+        self._max_tenants = max_tenants
+        self._clock = clock
+        self._usage: "OrderedDict[str, TenantUsage]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.interrupted = 0
+
+    def _get_usage(self, tenant_id: str, now: float) -> TenantUsage:
+        """Call with the lock held"""
+        usage = self._usage.get(tenant_id)
+        if usage is None:
+            bucket = TokenBucket(self._request_rate, self._request_burst, now) if self._request_rate > 0 else None
+            usage = self._usage[tenant_id] = TenantUsage(bucket, now)
+            # forget the least recently seen tenants, they start over with a full bucket
+            while len(self._usage) > self._max_tenants:
+                self._usage.popitem(last=False)
+        else:
+            self._usage.move_to_end(tenant_id)
+        if now - usage.window_start >= self._sql_window:
+            usage.window_start = now
+            usage.sql_time = 0.0
+        return usage
+
+    def check(self, tenant_id: str):
+        """Admit a request or raise QuotaExceededError"""
+        now = self._clock()
+        with self._lock:
+            usage = self._get_usage(tenant_id, now)
+            if self._sql_budget > 0 and usage.sql_time >= self._sql_budget:
+                self.rejected += 1
+                raise QuotaExceededError(retry_after=usage.window_start + self._sql_window - now)
+            if usage.bucket is not None:
+                wait = usage.bucket.take(now)
+                if wait:
+                    self.rejected += 1
+                    raise QuotaExceededError(retry_after=wait)
+
+    def record_sql_time(self, tenant_id: str, seconds: float):
+        with self._lock:
+            self._get_usage(tenant_id, self._clock()).sql_time += seconds
+
+    def sql_time(self, tenant_id: str) -> float:
+        with self._lock:
+            return self._get_usage(tenant_id, self._clock()).sql_time
+
+    def instrument(self, engine: sqlalchemy.engine.Engine, tenant_id: str):
+        """Measure and limit the SQL time of every connection `engine` makes for `tenant_id`"""
+        clock = self._clock
+        query_time_limit = self._query_time_limit
+        if query_time_limit <= 0 and self._sql_budget <= 0:
+            return
+
+        def finish(info: dict):
+            started = info.pop("query_started", None)
+            active = info.pop("query_active", None)
+            if started is not None:
+                self.record_sql_time(tenant_id, active - started)
+
+        @event.listens_for(engine, "connect")
+        def set_progress_handler(dbapi_connection, connection_record):
+            # the same dict as Connection.info in the cursor events below
+            info = connection_record.info
+
+            def progress() -> bool:
+                started = info.get("query_started")
+                if started is None:
+                    return False
+                # sqlite also steps through here while rows are fetched, long after execute() returned
+                now = info["query_active"] = clock()
+                if query_time_limit > 0 and now - started > query_time_limit:
+                    self.interrupted += 1
+                    return True
+                return False
+            dbapi_connection.set_progress_handler(progress, PROGRESS_STEPS)
+
+        # a statement runs until its result is exhausted, which no event marks: it's
+        # charged up to its last step once the connection runs another one or is returned
+        @event.listens_for(engine, "before_cursor_execute")
+        def start_timer(conn, cursor, statement, parameters, context, executemany):
+            finish(conn.info)
+            conn.info["query_started"] = conn.info["query_active"] = clock()
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def mark_active(conn, cursor, statement, parameters, context, executemany):
+            conn.info["query_active"] = clock()
+
+        @event.listens_for(engine, "handle_error")
+        def stop_timer_on_error(exception_context):
+            if exception_context.connection is not None:
+                finish(exception_context.connection.info)
+
+        @event.listens_for(engine, "checkin")
+        def stop_timer_on_checkin(dbapi_connection, connection_record):
+            finish(connection_record.info)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tenants": len(self._usage), "rejected": self.rejected, "interrupted": self.interrupted}
@@ -0,0 +1,215 @@
+"""Immutable snapshots of query results for the templates.
+
+Templates only ever read, so handing them ORM instances just means dragging
+identity-map state around and risking lazy loads halfway through a render.
+These records carry precomputed `value`/`invoiced`/`paid` fields and hold no
+reference back to the session, so the session can be closed before rendering.
+"""
+import re
+from datetime import date
+from decimal import Decimal
+from typing import NamedTuple, Optional
+
+from sqlalchemy import tuple_
+from sqlalchemy.orm import selectinload
+
+from . import model
+from .money import InvoiceTotals, from_cents, invoice_totals, to_cents
+
+
+class DeliverableView(NamedTuple):
+    id: int
+    name: str
+    value: Optional[Decimal]
+    cents: Optional[int]
+    due_date: Optional[date]
+    invoiced: bool
+    paid: bool
+
+
+class DeliverableName(NamedTuple):
+    id: int
+    name: str
+
+
+class LineItemView(NamedTuple):
+    id: int
+    deliverable: DeliverableName
+    value: Decimal
+    cents: int
+
+
+class AdjustmentView(NamedTuple):
+    """A credit or a reimbursement"""
+    id: int
+    reason: str
+    value: Decimal
+    cents: int
+
+
+class InvoiceView(NamedTuple):
+    id: int
+    name: str
+    version: int
+    sent: Optional[date]
+    paid: Optional[date]
+    line_items: tuple
+    credits: tuple
+    reimbursements: tuple
+    totals: InvoiceTotals
+
+
+class ProjectView(NamedTuple):
+    id: int
+    name: str
+    version: int
+    deliverables: tuple
+    invoices: tuple
+
+
+# "<due date>.<deliverable id>", the id bounded so it fits a sqlite integer
+DUE_CURSOR_PATTERN = re.compile(r"(\d{4}-\d{2}-\d{2})\.(\d{1,18})")
+
+
+class DueDeliverableView(NamedTuple):
+    id: int
+    name: str
+    value: Optional[Decimal]
+    cents: Optional[int]
+    due_date: date
+    overdue: bool
+    project_id: int
+    project_name: str
+
+
+class DuePage(NamedTuple):
+    deliverables: tuple
+    # keyset cursor for the page after this one, None on the last page
+    next: Optional[str]
+
+
+# eager loads for everything project_view touches, so building it never lazy-loads
+PROJECT_VIEW_OPTIONS = (
+    selectinload(model.Project.deliverables)
+        .joinedload(model.Deliverable.line_item)
+        .joinedload(model.InvoiceLineItem.invoice),
+    selectinload(model.Project.invoices).options(
+        selectinload(model.Invoice.line_items).joinedload(model.InvoiceLineItem.deliverable),
+        selectinload(model.Invoice.credits),
+        selectinload(model.Invoice.reimbursements),
+    ),
+)
+
+INVOICE_VIEW_OPTIONS = (
+    selectinload(model.Invoice.line_items).joinedload(model.InvoiceLineItem.deliverable),
+    selectinload(model.Invoice.credits),
+    selectinload(model.Invoice.reimbursements),
+)
+
+
+def deliverable_view(deliverable: model.Deliverable) -> DeliverableView:
+    line_item = deliverable.line_item
+    cents = deliverable.cents if deliverable.estimate is not None else None
+    return DeliverableView(
+        id=deliverable.id,
+        name=deliverable.name,
+        value=from_cents(cents) if cents is not None else None,
+        cents=cents,
+        due_date=deliverable.due_date,
+        invoiced=line_item is not None,
+        paid=line_item is not None and line_item.invoice.paid is not None,
+    )
+
+
+def line_item_view(line_item: model.InvoiceLineItem) -> LineItemView:
+    cents = line_item.cents
+    return LineItemView(
+        id=line_item.id,
+        deliverable=DeliverableName(id=line_item.deliverable.id, name=line_item.deliverable.name),
+        value=from_cents(cents),
+        cents=cents,
+    )
+
+
+def adjustment_view(adjustment) -> AdjustmentView:
+    cents = adjustment.cents
+    return AdjustmentView(id=adjustment.id, reason=adjustment.reason, value=from_cents(cents), cents=cents)
+
+
+def invoice_view(invoice: model.Invoice) -> InvoiceView:
+    line_items = tuple(line_item_view(line_item) for line_item in invoice.line_items)
+    credits = tuple(adjustment_view(c) for c in invoice.credits)
+    reimbursements = tuple(adjustment_view(r) for r in invoice.reimbursements)
+    return InvoiceView(
+        id=invoice.id,
+        name=invoice.name,
+        version=invoice.version,
+        sent=invoice.sent,
+        paid=invoice.paid,
+        line_items=line_items,
+        credits=credits,
+        reimbursements=reimbursements,
+        totals=invoice_totals(
+            (i.cents for i in line_items), (c.cents for c in credits), (r.cents for r in reimbursements),
+        ),
+    )
+
+
+def project_view(project: model.Project) -> ProjectView:
+    return ProjectView(
+        id=project.id,
+        name=project.name,
+        version=project.version,
+        deliverables=tuple(deliverable_view(d) for d in project.deliverables),
+        invoices=tuple(invoice_view(i) for i in project.invoices),
+    )
+
+
+def due_cursor(deliverable: DueDeliverableView) -> str:
+    return f"{deliverable.due_date.isoformat()}.{deliverable.id}"
+
+
+def parse_due_cursor(cursor: str) -> tuple[date, int]:
+    """Raises ValueError for anything `due_cursor` can't have made"""
+    match = DUE_CURSOR_PATTERN.fullmatch(cursor)
+    if match is None:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return date.fromisoformat(match[1]), int(match[2])
+
+
+def due_page(db, today: date, until: date, after: Optional[tuple[date, int]] = None, limit: int = 50) -> DuePage:
+    """Live, uninvoiced deliverables across all live projects due by `until`, overdue first.
+
+    Reads `ix_deliverable_due` in order, picking up after the parsed `after` cursor, so every
+    page costs the same however far in it is.
+    """
+    query = db.query(
+        model.Deliverable.id, model.Deliverable.name, model.Deliverable.estimate, model.Deliverable.due_date,
+        model.Project.id, model.Project.name,
+    ).join(model.Deliverable.project).filter(
+        # the index's own WHERE clause, sqlite only uses a partial index when the query repeats it
+        model.Deliverable.archived_at.is_(None),
+        model.Deliverable.invoiced_at.is_(None),
+        model.Deliverable.due_date.isnot(None),
+        model.Deliverable.due_date <= until,
+        model.Project.archived_at.is_(None),
+    )
+    if after is not None:
+        query = query.filter(tuple_(model.Deliverable.due_date, model.Deliverable.id) > after)
+    # one extra row tells us whether there is a next page
+    rows = query.order_by(model.Deliverable.due_date, model.Deliverable.id).limit(limit + 1).all()
+    deliverables = []
+    for id, name, estimate, due_date, project_id, project_name in rows[:limit]:
+        cents = to_cents(estimate) if estimate is not None else None
+        deliverables.append(DueDeliverableView(
+            id=id,
+            name=name,
+            value=from_cents(cents) if cents is not None else None,
+            cents=cents,
+            due_date=due_date,
+            overdue=due_date < today,
+            project_id=project_id,
+            project_name=project_name,
+        ))
+    next = due_cursor(deliverables[-1]) if len(rows) > limit else None
+    return DuePage(deliverables=tuple(deliverables), next=next)
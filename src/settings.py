@@ -10,3 +10,27 @@ class Settings(BaseSettings):
     DEPLOYMENT: str = "local" # "private", "demo"
     PASSWORD: str = os.getenv("AUTH_PASSWORD")
     SECRET_KEY: str = os.getenv("SECRET_KEY")
+    DATABASE_BUSY_TIMEOUT: float = 5.0 # seconds sqlite waits on a lock before raising
+    DATABASE_RETRY_ATTEMPTS: int = 3
+    DATABASE_RETRY_BACKOFF: float = 0.05 # seconds, doubled on each attempt
+    HEADER_CACHE_SIZE: int = 4096 # project headers, across all tenants
+    HEADER_CACHE_TTL: float = 300.0 # seconds
+    STREAM_PROJECT_DETAIL: bool = True # send project pages as they render instead of all at once
+    DUE_UPCOMING_DAYS: int = 14 # how far ahead the due list looks
+    DUE_PAGE_SIZE: int = 50
+    IDEMPOTENCY_KEY_TTL: float = 86400.0 # seconds a POST's idempotency key replays its response
+    MAINTENANCE_INTERVAL: float = 3600.0 # seconds between background maintenance passes, 0 disables
+    MAINTENANCE_PAGE_BUDGET: int = 10000 # max pages incrementally vacuumed per pass
+    MAINTENANCE_PAUSE: float = 0.05 # seconds between databases within a pass
+    MAINTENANCE_IDLE_TENANT_DAYS: float = 30.0 # demo tenants untouched this long are deleted
+    BACKUP_PAGES_PER_STEP: int = 256 # pages copied per sqlite backup step
+    BACKUP_STEP_SLEEP: float = 0.005 # seconds between backup steps, so writers get a turn
+    QUOTA_REQUEST_RATE: float = 5.0 # requests per second per demo tenant, 0 disables
+    QUOTA_REQUEST_BURST: int = 30
+    QUOTA_SQL_BUDGET: float = 5.0 # seconds of SQL per demo tenant per window, 0 disables
+    QUOTA_SQL_WINDOW: float = 60.0 # seconds
+    QUOTA_QUERY_TIME_LIMIT: float = 2.0 # seconds a single demo tenant statement may run, 0 disables
+    DEMO_STORAGE: str = "disk" # "memory": demo tenants live in memory, persisted to DATABASE_DIRECTORY
+    MEMORY_PERSIST_INTERVAL: float = 30.0 # seconds between copying changed in-memory tenants to disk
+    MEMORY_IDLE_TENANT_SECONDS: float = 600.0 # in-memory tenants untouched this long are persisted and dropped
+    MEMORY_MAX_TENANTS: int = 500
@@ -1,6 +1,22 @@
+import re
+
+# what `secrets.token_hex(24)` gives, and all a demo tenant id may ever be
+TENANT_ID_PATTERN = re.compile(r"[0-9a-f]{48}")
+
+
+def is_valid_tenant_id(tenant_id) -> bool:
+    return isinstance(tenant_id, str) and TENANT_ID_PATTERN.fullmatch(tenant_id) is not None
+
 
 def render_currency(input):
     """$1,352.02 or -$94.59"""
     val = abs(input)
     sign = "-" if input < 0 else ""
-    return f"{sign}${val:,.2f}"
\ No newline at end of file
+    return f"{sign}${val:,.2f}"
+
+
+def render_cents(cents: int):
+    """Same output as `render_currency`, from integer cents: 135202 -> $1,352.02"""
+    sign = "-" if cents < 0 else ""
+    dollars, remainder = divmod(abs(cents), 100)
+    return f"{sign}${dollars:,}.{remainder:02d}"
@@ -0,0 +1,50 @@
+"""In-memory demo tenants under concurrent requests.
+
+A busy tenant's requests have to wait their turn on its lock, the way they do on
+its file, instead of failing the moment another request holds it.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src import model
+from src.memory_tenants import InMemoryMultitenantDatabaseProxy
+
+TENANT = "ab" * 24
+
+
+def test_concurrent_reads_and_writes_wait_for_the_lock(tmp_path):
+    proxy = InMemoryMultitenantDatabaseProxy(tmp_path, busy_timeout=5.0)
+    with proxy.get_session(TENANT) as db:
+        db.add(model.Project(name="p"))
+        db.commit()
+    start = threading.Barrier(16)
+
+    def work(worker: int):
+        start.wait()
+        for i in range(40):
+            with proxy.get_session(TENANT, readonly=i % 2 == 1) as db:
+                if i % 2:
+                    db.query(model.Deliverable).filter_by(project_id=1).all()
+                else:
+                    db.add(model.Deliverable(project_id=1, name=f"{worker}-{i}", estimate=1))
+                    db.commit()
+
+    with ThreadPoolExecutor(16) as executor:
+        # re-raises the first failure
+        list(executor.map(work, range(16)))
+    with proxy.get_session(TENANT) as db:
+        assert db.query(model.Deliverable).count() == 16 * 20
+    proxy.stop()
+
+
+def test_tenants_are_separate_databases(tmp_path):
+    proxy = InMemoryMultitenantDatabaseProxy(tmp_path)
+    other = "cd" * 24
+    for tenant, name in ((TENANT, "mine"), (other, "theirs")):
+        with proxy.get_session(tenant) as db:
+            db.add(model.Project(name=name))
+            db.commit()
+    with proxy.get_session(TENANT) as db:
+        assert [p.name for p in db.query(model.Project)] == ["mine"]
+    proxy.stop()
+    assert proxy.get_session(other).query(model.Project).one().name == "theirs"
@@ -0,0 +1,101 @@
+"""Integer cents against the Decimal code they replaced.
+
+`old_value` and `OldInvoice` are the quantize-everything implementations that
+`BaseValueModel.value` and `Invoice`'s totals had before `money`; every amount and
+total has to come out the same, half-cent ties included.
+"""
+import itertools
+import random
+from decimal import ROUND_HALF_UP, Decimal
+
+import pytest
+
+from src import model
+from src.money import from_cents, invoice_totals, to_cents
+from src.utils import render_cents, render_currency
+
+SEEDS = range(20)
+
+
+def old_value(amount) -> Decimal:
+    return Decimal(amount).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+class OldInvoice:
+    def __init__(self, line_items, credits, reimbursements):
+        self.line_items = [old_value(a) for a in line_items]
+        self.credits = [old_value(-a) for a in credits]
+        self.reimbursements = [old_value(a) for a in reimbursements]
+
+    @property
+    def balance_due(self):
+        return sum(itertools.chain(self.line_items, self.credits, self.reimbursements))
+
+    @property
+    def gross_pay(self):
+        return sum(v for v in itertools.chain(self.line_items, self.credits, self.reimbursements) if v > 0)
+
+    @property
+    def reimbursements_total(self):
+        return sum(self.reimbursements)
+
+    @property
+    def net_pay(self):
+        return self.balance_due - self.reimbursements_total
+
+
+def random_amount(rng: random.Random) -> Decimal:
+    kind = rng.randrange(5)
+    if kind == 0:
+        # an exact half cent: the tie ROUND_HALF_UP has to push away from zero
+        amount = Decimal(rng.randrange(-10**7, 10**7)).scaleb(-2) + Decimal("0.005")
+    elif kind == 1:
+        amount = Decimal(rng.randrange(10**9)).scaleb(-rng.randrange(7))
+    elif kind == 2:
+        amount = Decimal(rng.uniform(-1e5, 1e5))
+    elif kind == 3:
+        amount = Decimal(str(round(rng.uniform(0, 1e4), 3)))
+    else:
+        amount = Decimal(rng.randrange(-10**6, 10**6))
+    return -amount if rng.random() < 0.2 else amount
+
+
+@pytest.mark.parametrize("amount", [
+    "0", "0.005", "-0.005", "0.004999", "0.015", "0.025", "10.005", "-0.125", "1352.015",
+    "99999999.995", "-99999999.995", "1E+3", "1.23E-7", "0.0050000001",
+])
+def test_rounding_ties(amount):
+    assert from_cents(to_cents(Decimal(amount))) == old_value(amount)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_rounding_matches_quantize(seed):
+    rng = random.Random(seed)
+    for _ in range(2000):
+        amount = random_amount(rng)
+        cents = to_cents(amount)
+        assert from_cents(cents) == old_value(amount), amount
+        assert render_cents(cents) == render_currency(old_value(amount)), amount
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_invoice_totals_match_decimal_sums(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        line_items = [random_amount(rng) for _ in range(rng.randrange(12))]
+        credits = [random_amount(rng) for _ in range(rng.randrange(4))]
+        reimbursements = [random_amount(rng) for _ in range(rng.randrange(4))]
+        old = OldInvoice(line_items, credits, reimbursements)
+        invoice = model.Invoice(
+            line_items=[model.InvoiceLineItem(amount=a) for a in line_items],
+            credits=[model.InvoiceCredit(amount=a) for a in credits],
+            reimbursements=[model.InvoiceReimbursement(amount=a) for a in reimbursements],
+        )
+        for total in ("balance_due", "gross_pay", "reimbursements_total", "net_pay"):
+            assert getattr(invoice, total) == getattr(old, total), (total, line_items, credits, reimbursements)
+        assert render_cents(invoice.totals.net_pay) == render_currency(old.net_pay)
+
+
+def test_invoice_totals_of_nothing():
+    assert invoice_totals((), (), ()) == (0, 0, 0, 0)
+    assert model.Invoice().balance_due == OldInvoice((), (), ()).balance_due == 0